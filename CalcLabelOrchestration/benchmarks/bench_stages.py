@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the per-substack stages on synthetic label volumes.
+
+A grid of overlapping substacks is generated with the session layout the
+stages expect (segmentation.h5 and max_body.json in each substack directory,
+configuration jsons written by the Substack task methods).  Bodies are boxes
+with random extents, labeled independently in every substack, so stitching
+has to match them across the overlaps.  Each stage's execute runs in its own
+process (extract_faces, stitch_labels, the merge consolidation of
+orchestrate_labeling, remap_labels and commit_labels against a local
+DVID stand-in server, and write_labels, the fused remap and commit the
+orchestrator runs) and the throughput and peak RSS of every stage are
+reported.  Run from the CalcLabelOrchestration directory, e.g.
+
+    python benchmarks/bench_stages.py --grid 2 2 2 --size 512
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import h5py
+import numpy
+
+sys.path.insert(0, ".")
+from orchestration.calclabels_cluster import Bbox, Substack
+from orchestration.spatial_index import find_stitch_pairs
+from orchestration.unionfind import UnionFind
+from dvid_standin import StandInServer
+
+layoutName = "layout.json"
+
+# settings the tasks read from the orchestration options
+class BenchOptions:
+    def __init__(self, stitch_mode, label_format):
+        self.stitch_mode = stitch_mode
+        self.stitch_thresholds = {}
+        self.label_format = label_format
+
+# random box boundaries along one axis with the given mean spacing
+def make_cuts(span, body_size, rs):
+    steps = rs.randint(body_size / 2 + 1, body_size * 3 / 2 + 1, size=span / (body_size / 2 + 1) + 2)
+    return numpy.cumsum(steps)
+
+# labels (z, y, x) of the synthetic bodies in [lower, upper), ids local to the region
+def make_labels(cuts, lower, upper):
+    indices = [numpy.searchsorted(cuts[axis], numpy.arange(lower[axis], upper[axis]), side="right") for axis in range(3)]
+    ncuts = [len(cuts[axis]) + 1 for axis in range(3)]
+    labels = (indices[2][:, None, None] * ncuts[1] + indices[1][None, :, None]) * ncuts[0] + indices[0][None, None, :]
+    ids, labels = numpy.unique(labels, return_inverse=True)
+    return (labels + 1).astype(numpy.uint32).reshape([upper[axis] - lower[axis] for axis in (2, 1, 0)])
+
+# write segmentation.h5 and max_body.json for a grid of substacks, returns the substacks
+def generate(workdir, grid, size, border, body_size, seed):
+    rs = numpy.random.RandomState(seed)
+    cuts = [make_cuts(grid[axis] * size + 2 * border, body_size, rs) - border for axis in range(3)]
+
+    substacks = []
+    for x in range(grid[0]):
+        for y in range(grid[1]):
+            for z in range(grid[2]):
+                roi = Bbox(x * size, y * size, z * size, (x+1) * size, (y+1) * size, (z+1) * size)
+                substack = Substack(len(substacks), roi, border)
+                substack.create_directory(workdir)
+                substacks.append(substack)
+
+                labels = make_labels(cuts, [roi.x1 - border, roi.y1 - border, roi.z1 - border],
+                        [roi.x2 + border, roi.y2 + border, roi.z2 + border])
+                hfile = h5py.File(substack.session_location + "/segmentation.h5", 'w')
+                hfile.create_dataset("stack", data=labels)
+                hfile.close()
+                json.dump({"max_id": int(labels.max())}, open(substack.session_location + "/max_body.json", 'w'))
+    return substacks
+
+def write_layout(workdir, substacks):
+    layout = []
+    for substack in substacks:
+        roi = substack.roi
+        layout.append({"roi": [roi.x1, roi.y1, roi.z1, roi.x2, roi.y2, roi.z2], "border": substack.border,
+            "num_stitch": substack.num_stitch})
+    json.dump(layout, open(workdir + "/" + layoutName, 'w'))
+
+def read_layout(workdir):
+    substacks = []
+    for entry in json.load(open(workdir + "/" + layoutName)):
+        substack = Substack(len(substacks), Bbox(*entry["roi"]), entry["border"])
+        substack.create_directory(workdir)
+        substack.num_stitch = entry["num_stitch"]
+        substacks.append(substack)
+    return substacks
+
+# merge consolidation as done by orchestrate_labeling, writes the remap shards
+def consolidate(workdir):
+    substacks = read_layout(workdir)
+    id_offset = 0
+    merge_arrays = [numpy.zeros((0, 2), dtype=numpy.uint64)]
+    for substack in substacks:
+        id_offset = substack.set_max_id(id_offset)
+    for substack in substacks:
+        merge_arrays.append(substack.find_mappings(substack.read_merge_lists(), substacks))
+
+    merge_sets = UnionFind(id_offset + 1)
+    merge_array = numpy.concatenate(merge_arrays)
+    merge_sets.union_pairs(merge_array[:,0], merge_array[:,1])
+    bodies, targets = merge_sets.mappings()
+
+    order = numpy.argsort(bodies, kind="mergesort")
+    bodies = bodies[order]
+    targets = targets[order]
+    for substack in substacks:
+        substack.write_remap_shard(bodies, targets)
+
+# run one stage in this process (called by run_stage) and print its time
+def run_in_process(stage, argument):
+    start = time.time()
+    if stage == "consolidate":
+        consolidate(argument)
+    else:
+        module = __import__("orchestration." + stage, fromlist=["execute"])
+        sys.argv = [stage, argument]
+        module.execute(sys.argv)
+    sys.stdout.write("\n" + json.dumps({"seconds": time.time() - start}) + "\n")
+
+# run a stage in a new process, returns seconds and peak RSS (MB)
+def run_stage(stage, argument, env):
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--run-stage", stage, argument],
+            stdout=subprocess.PIPE, env=env)
+    output = process.stdout.read()
+    pid, status, usage = os.wait4(process.pid, 0)
+    if status != 0:
+        raise Exception(stage + " failed on " + argument + ":\n" + output)
+    seconds = json.loads(output.strip().split("\n")[-1])["seconds"]
+    return seconds, usage.ru_maxrss / 1024.0
+
+def core_voxels(substack):
+    roi = substack.roi
+    return (roi.x2 - roi.x1) * (roi.y2 - roi.y1) * (roi.z2 - roi.z1)
+
+# voxels of the overlap a stitch job compares
+def overlap_voxels(config_file):
+    config = json.load(open(config_file))
+    voxels = 1
+    for axis in range(3):
+        voxels *= max(min(config["bbox2"][axis], config["bbox2_2"][axis]) - max(config["bbox1"][axis], config["bbox1_2"][axis]), 0)
+    return voxels
+
+def report(stage, num_jobs, voxels, results):
+    seconds = sum([result[0] for result in results])
+    peak_rss = max([result[1] for result in results])
+    print "%-12s %6d %14d %10.2f %14.0f %10.1f" % (stage, num_jobs, voxels, seconds, voxels / max(seconds, 1e-9), peak_rss)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark orchestration stages on synthetic volumes")
+    parser.add_argument('--grid', type=int, nargs=3, default=[2, 2, 1], help="Number of substacks along x, y and z")
+    parser.add_argument('--size', type=int, default=256, help="Substack size (without border)")
+    parser.add_argument('--border', type=int, default=20, help="Substack border (half the overlap size)")
+    parser.add_argument('--body-size', type=int, default=32, help="Mean body extent along each axis")
+    parser.add_argument('--stitch-mode', type=int, default=2)
+    parser.add_argument('--compression', type=str, default="lzf", help="Compression of intermediate label volumes (lzf, gzip or none)")
+    parser.add_argument('--slab-memory-mb', type=float, default=512, help="Memory budget of a remap slab")
+    parser.add_argument('--busy-rate', type=float, default=0.0, help="Fraction of DVID writes answered with 503")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', type=str, default=None, help="Directory for the synthetic session (default: temporary, removed)")
+    parser.add_argument('--run-stage', type=str, nargs=2, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv[1:])
+
+    if args.run_stage is not None:
+        run_in_process(*args.run_stage)
+        return
+
+    workdir = args.workdir
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix="bench_stages")
+    elif not os.path.exists(workdir):
+        os.makedirs(workdir)
+
+    try:
+        start = time.time()
+        substacks = generate(workdir, args.grid, args.size, args.border, args.body_size, args.seed)
+        print "generated", len(substacks), "substacks in", time.time() - start, "seconds"
+
+        server = StandInServer(busy_rate=args.busy_rate)
+        server.start()
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.path.abspath(".") + ":" + env.get("PYTHONPATH", "")
+
+        print "%-12s %6s %14s %10s %14s %10s" % ("stage", "jobs", "voxels", "seconds", "voxels/s", "peak MB")
+
+        options = BenchOptions(args.stitch_mode, {"compression": args.compression})
+        stitch_pairs = find_stitch_pairs(substacks)
+        for i, j in stitch_pairs:
+            substacks[i].add_face(substacks[j])
+            substacks[j].add_face(substacks[i])
+        tasks = [substack.faces_task(options) for substack in substacks if len(substack.faces) > 0]
+        results = [run_stage("extract_faces", task.args[0], env) for task in tasks]
+        if len(tasks) > 0:
+            report("faces", len(tasks), sum([core_voxels(substack) for substack in substacks if len(substack.faces) > 0]), results)
+
+        tasks = [substacks[i].stitch_task(substacks[j], options) for i, j in stitch_pairs]
+        results = [run_stage("stitch_labels", task.args[0], env) for task in tasks]
+        if len(tasks) > 0:
+            report("stitch", len(tasks), sum([overlap_voxels(task.args[0]) for task in tasks]), results)
+        write_layout(workdir, substacks)
+
+        num_voxels = sum([core_voxels(substack) for substack in substacks])
+        report("consolidate", 1, num_voxels, [run_stage("consolidate", workdir, env)])
+
+        id_offset = 0
+        for substack in substacks:
+            id_offset = substack.set_max_id(id_offset)
+
+        config = {"roi": "", "server": server.url(), "uuid": "bench", "labelname": "bench",
+                "label-format": options.label_format, "slab-memory-mb": args.slab_memory_mb,
+                "skip-empty-blocks": True}
+        tasks = [substack.remap_task(config) for substack in substacks]
+        report("remap", len(tasks), num_voxels, [run_stage("remap_labels", task.args[0], env) for task in tasks])
+
+        tasks = [substack.write_task(config) for substack in substacks]
+        report("commit", len(tasks), num_voxels, [run_stage("commit_labels", task.args[0], env) for task in tasks])
+
+        tasks = [substack.remap_write_task(config) for substack in substacks]
+        report("remap+commit", len(tasks), num_voxels, [run_stage("write_labels", task.args[0], env) for task in tasks])
+        print "DVID stand-in received", server.num_posts, "posts,", server.num_voxels, "voxels,", server.num_bytes, "bytes"
+        server.shutdown()
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+"""
+Benchmark merge consolidation on synthetic merge lists.
+
+Merge lists mimic stitch output: each edge joins a body with a body of
+smaller id, with ids drawn from a dense space a few times larger than the
+number of edges.  --shape star instead joins one large body to every other
+body (a glial or falsely merged body touching many fragments), which is the
+worst case for hooking.  Run from the CalcLabelOrchestration directory, e.g.
+
+    python benchmarks/bench_unionfind.py --edges 1000000 10000000 100000000
+    python benchmarks/bench_unionfind.py --shape star --edges 1000 16000 200000
+"""
+
+import argparse
+import resource
+import sys
+import time
+import numpy
+
+sys.path.insert(0, ".")
+from orchestration.unionfind import UnionFind
+
+# merge consolidation used by orchestrate_labeling before the union-find
+def legacy_consolidate(merge_list):
+    body1body2 = {}
+    body2body1 = {}
+    for merger in merge_list:
+        body1 = merger[0]
+        if merger[0] in body1body2:
+            body1 = body1body2[merger[0]]
+        body2 = merger[1]
+        if merger[1] in body1body2:
+            body2 = body1body2[merger[1]]
+        if body2 not in body2body1:
+            body2body1[body2] = set()
+        body2body1[body2].add(body1)
+        body1body2[body1] = body2
+        if body1 in body2body1:
+            for tbody in body2body1[body1]:
+                body2body1[body2].add(tbody)
+                body1body2[tbody] = body2
+    return body1body2
+
+# synthetic merge list with larger body id first
+def make_merges(num_edges, id_ratio, seed):
+    rs = numpy.random.RandomState(seed)
+    max_id = int(num_edges * id_ratio)
+    bodies1 = rs.randint(1, max_id + 1, size=num_edges).astype(numpy.uint64)
+    bodies2 = rs.randint(1, max_id + 1, size=num_edges).astype(numpy.uint64)
+    return numpy.maximum(bodies1, bodies2), numpy.minimum(bodies1, bodies2), max_id
+
+# synthetic merge list where one body is joined to every smaller body
+def make_star_merges(num_edges, seed):
+    rs = numpy.random.RandomState(seed)
+    max_id = num_edges + 1
+    bodies2 = rs.permutation(numpy.arange(1, max_id, dtype=numpy.uint64))
+    bodies1 = numpy.empty(num_edges, dtype=numpy.uint64)
+    bodies1.fill(max_id)
+    return bodies1, bodies2, max_id
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark merge consolidation")
+    parser.add_argument('--edges', type=int, nargs='+', default=[1000000, 10000000, 100000000], help="Merge list sizes to run")
+    parser.add_argument('--id-ratio', type=float, default=4.0, help="Size of body id space relative to the number of edges")
+    parser.add_argument('--legacy-max', type=int, default=100000, help="Also time the dict-based consolidation up to this many edges")
+    parser.add_argument('--shape', type=str, default="random", choices=["random", "star"], help="Shape of the synthetic merge graph")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv[1:])
+
+    print "edges, seconds, edges/s, mapped bodies, peak RSS (MB)"
+    for num_edges in args.edges:
+        if args.shape == "star":
+            bodies1, bodies2, max_id = make_star_merges(num_edges, args.seed)
+        else:
+            bodies1, bodies2, max_id = make_merges(num_edges, args.id_ratio, args.seed)
+
+        start = time.time()
+        merge_sets = UnionFind(max_id + 1)
+        merge_sets.union_pairs(bodies1, bodies2)
+        bodies, targets = merge_sets.mappings()
+        total_time = time.time() - start
+        print "union-find", num_edges, total_time, num_edges / total_time, len(bodies), peak_rss_mb()
+
+        if num_edges <= args.legacy_max:
+            merge_list = zip(bodies1.tolist(), bodies2.tolist())
+            start = time.time()
+            mapping = legacy_consolidate(merge_list)
+            total_time = time.time() - start
+            print "legacy", num_edges, total_time, num_edges / total_time, len(mapping), peak_rss_mb()
+
+        del bodies1, bodies2, merge_sets, bodies, targets
+
+if __name__ == "__main__":
+    main(sys.argv)
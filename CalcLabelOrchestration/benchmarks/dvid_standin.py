@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""
+Local stand-in for the DVID labelblk raw write endpoint.
+
+Accepts POST /api/node/<uuid>/<labelname>/raw/0_1_2/<sx>_<sy>_<sz>/<x>_<y>_<z>
+with an optional compression=gzip query, checks the payload size and counts
+the posts, bytes and voxels received.  A fraction of requests can be
+answered with 503 (busy) to exercise retries, and the decoded subvolumes can
+be written to a directory (<x>_<y>_<z>_<sx>_<sy>_<sz>.bin, uint64) to check
+what was written.  Used by bench_stages.py; run on its own with e.g.
+
+    python benchmarks/dvid_standin.py --port 8000 --output /tmp/dvid
+"""
+
+import argparse
+import BaseHTTPServer
+import SocketServer
+import os
+import random
+import sys
+import threading
+import urlparse
+import zlib
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # small responses on kept-alive connections otherwise wait for delayed acks
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status, text=""):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+    def do_POST(self):
+        server = self.server
+        data = self.rfile.read(int(self.headers.getheader("Content-Length", 0)))
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+        parts = url.path.strip("/").split("/")
+        if len(parts) != 8 or parts[:2] != ["api", "node"] or parts[4:6] != ["raw", "0_1_2"]:
+            self.respond(400, "unsupported request " + self.path)
+            return
+
+        if random.random() < server.busy_rate:
+            self.respond(503, "busy")
+            return
+
+        if query.get("compression") == ["gzip"]:
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        sizes = [int(val) for val in parts[6].split("_")]
+        if len(data) != sizes[0] * sizes[1] * sizes[2] * 8:
+            self.respond(400, "payload has " + str(len(data)) + " bytes")
+            return
+
+        if server.output is not None:
+            fout = open(server.output + "/" + parts[7] + "_" + parts[6] + ".bin", 'wb')
+            fout.write(data)
+            fout.close()
+
+        server.lock.acquire()
+        server.num_posts += 1
+        server.num_voxels += sizes[0] * sizes[1] * sizes[2]
+        server.num_bytes += int(self.headers.getheader("Content-Length", 0))
+        server.lock.release()
+        self.respond(200)
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, busy_rate=0.0, output=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", port), StandInHandler)
+        self.busy_rate = busy_rate
+        self.output = output
+        self.lock = threading.Lock()
+        self.num_posts = 0
+        self.num_voxels = 0
+        self.num_bytes = 0
+
+    def url(self):
+        return "http://127.0.0.1:" + str(self.server_address[1])
+
+    # serve from a background thread
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Stand-in for DVID label writes")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--busy-rate', type=float, default=0.0, help="Fraction of posts answered with 503")
+    parser.add_argument('--output', type=str, default=None, help="Directory for the received subvolumes")
+    args = parser.parse_args(argv[1:])
+
+    if args.output is not None and not os.path.exists(args.output):
+        os.makedirs(args.output)
+    server = StandInServer(args.port, args.busy_rate, args.output)
+    print "listening on", server.url()
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,68 @@
+import os
+import h5py
+import numpy
+
+"""
+Spatially coherent assignment of bodies to substacks.
+
+The remap stage writes the size of every final body within the core of its
+substack (bodiesName in the substack directory).  Each body is assigned to
+the substack that holds most of its voxels, so a job working on the bodies
+of one substack only touches DVID data in and around that substack instead
+of bodies scattered over the whole volume.
+"""
+
+bodiesName = "bodies.h5"
+
+# final body ids and voxel counts (0 excluded) of a remapped label volume
+def body_sizes(labels):
+    ids, sizes = numpy.unique(labels, return_counts=True)
+    keep = ids != 0
+    return ids[keep].astype(numpy.uint64), sizes[keep].astype(numpy.uint64)
+
+def write_body_sizes(filename, ids, sizes):
+    fout = h5py.File(filename, 'w')
+    fout.create_dataset("ids", data=ids)
+    fout.create_dataset("sizes", data=sizes)
+    fout.close()
+
+def read_body_sizes(filename):
+    if not os.path.exists(filename):
+        return numpy.zeros(0, numpy.uint64), numpy.zeros(0, numpy.uint64)
+    hfile = h5py.File(filename, 'r')
+    ids = hfile["ids"][:]
+    sizes = hfile["sizes"][:]
+    hfile.close()
+    return ids, sizes
+
+# body ids (sorted) for each substack; a body goes to the substack with most of its voxels (lowest index on ties)
+def assign_bodies(filenames):
+    all_ids = []
+    all_sizes = []
+    all_substacks = []
+    for index, filename in enumerate(filenames):
+        ids, sizes = read_body_sizes(filename)
+        all_ids.append(ids)
+        all_sizes.append(sizes)
+        all_substacks.append(numpy.zeros(len(ids), numpy.int64) + index)
+    if len(filenames) == 0:
+        return []
+
+    ids = numpy.concatenate(all_ids).astype(numpy.uint64)
+    sizes = numpy.concatenate(all_sizes).astype(numpy.int64)
+    substacks = numpy.concatenate(all_substacks)
+
+    # order by body, then largest count, then substack index -- first entry of each body wins
+    order = numpy.lexsort((substacks, -sizes, ids))
+    ids = ids[order]
+    substacks = substacks[order]
+    first = numpy.ones(len(ids), dtype=bool)
+    first[1:] = ids[1:] != ids[:-1]
+    ids = ids[first]
+    substacks = substacks[first]
+
+    # group by substack (ids stay sorted within a group)
+    order = numpy.argsort(substacks, kind="mergesort")
+    ids = ids[order]
+    bounds = numpy.searchsorted(substacks[order], numpy.arange(len(filenames) + 1))
+    return [ids[bounds[index]:bounds[index+1]] for index in range(len(filenames))]
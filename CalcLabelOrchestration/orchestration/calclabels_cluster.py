@@ -3,11 +3,27 @@ import argparse
 import sys
 import json
 import requests
-import drmaa
 import time
 import numpy
 import h5py
 import traceback
+from orchestration.unionfind import UnionFind
+from orchestration.spatial_index import find_stitch_pairs
+from orchestration.job_array import Task
+from orchestration.executors import create_executor
+from orchestration.scheduler import DagScheduler
+from orchestration.manifest import Manifest
+from orchestration.synapses import SynapseTable
+from orchestration.telemetry import JobMetrics
+from orchestration.status import StatusPublisher
+from orchestration.body_assignment import assign_bodies, bodiesName
+from orchestration.extract_faces import face_name, face_bbox
+from orchestration.merge_lists import read_merge_list, summarize_merge_lists, stitchSummaryName
+from orchestration.stitch_labels import stitch_policy, redecide
+from orchestration.incremental import read_label_state, write_label_state, changed_substacks, allocate_offsets, Reconciliation
+from orchestration.relabel import write_mapping_shard, remapShardName
+from orchestration.partition import balanced_partition, grid_cell_size, uniform_cost_grid, roi_cost_grid, occupancy_cost_grid
+import hashlib
 
 """
 Basic Algorithm
@@ -35,6 +51,8 @@ computeGraph = "neuroproof_graph_build_dvid"
 computeProb = "neuroproof_agg_prob_dvid"
 agglomerateGraph = "neuroproof_graph_predict"
 stitchLabels = "stitch_labels"
+extractFaces = "extract_faces"
+writeLabels = "write_labels"
 
 
 # hold all options for command
@@ -58,6 +76,35 @@ class CommandOptions:
         self.stitch_mode = config_data["stitch-mode"]
         self.seed_size = config_data["seed-size"]
         self.agglom_threshold = config_data["agglom-threshold"]
+        # "drmaa" (SGE cluster) or "local" (process pool using local-slots slots)
+        self.executor = config_data.get("executor", "drmaa")
+        self.local_slots = config_data.get("local-slots", None)
+        # maximum number of submitted jobs per stage and of jobs using DVID (-l dvid=true)
+        self.stage_limits = {"watershed": 4000, "stitch": 9000, "write-labels": 4000, "compute-graph": 9000, "compute-prob": 10}
+        self.stage_limits.update(config_data.get("stage-limits", {}))
+        self.resource_limits = {}
+        if config_data.get("dvid-limit") is not None:
+            self.resource_limits["dvid"] = config_data["dvid-limit"]
+        # skip jobs completed by a previous run of this session
+        self.resume = False
+        # region [x1, y1, z1, x2, y2, z2) to segment again in an incremental run
+        self.changed_bbox = None
+        # minimum seconds between status updates sent to the callback
+        self.status_interval = config_data.get("status-interval", 5)
+        # "uniform" (job-size cubes) or "balanced" (substack cost estimated from the ROI or cost-map)
+        self.partition = config_data.get("partition", "uniform")
+        # h5 occupancy map used to estimate cost when there is no ROI
+        self.cost_map = config_data.get("cost-map", None)
+        # largest substack side for balanced partitions
+        self.max_job_size = config_data.get("max-job-size", 2 * self.job_size)
+        # compression and chunking of intermediate label volumes (see label_io)
+        self.label_format = config_data.get("label-format", {})
+        # overlap thresholds of the stitching policy (see stitch_labels)
+        self.stitch_thresholds = config_data.get("stitch-thresholds", {})
+        # memory budget of a remap z slab
+        self.slab_memory_mb = config_data.get("slab-memory-mb", 512)
+        # also write the remapped labels of each substack to segmentation2.h5 (debugging)
+        self.write_remapped = config_data.get("write-remapped", False)
 
 
 def num_divs(total_span, substack_span, min_allowed):
@@ -77,12 +124,18 @@ class Bbox:
         self.z2 = z2
 
 class Substack:
-    def __init__(self, substackid, main_region, boundbuffer):
+    def __init__(self, substackid, main_region, boundbuffer, cost=None):
         self.roi = main_region
         self.border = boundbuffer
         self.substackid = substackid
+        # estimated processing cost (default: number of voxels)
+        self.cost = cost
+        if self.cost is None:
+            self.cost = (main_region.x2 - main_region.x1) * (main_region.y2 - main_region.y1) * (main_region.z2 - main_region.z1)
         self.num_stitch = 0
         self.synapsedata = False
+        # (axis, side) of the faces shared with neighbors
+        self.faces = []
 
     # create working directory
     def create_directory(self, basepath):
@@ -124,88 +177,59 @@ class Substack:
     def set_max_id(self, id_offset):
         self.id_offset = id_offset
         data = json.load(open(self.session_location + "/max_body.json"))
+        self.max_id = data["max_id"]
         return id_offset + data["max_id"]
 
+    # write the mappings (sorted keys) of this substack's id range to its remap shard
+    def write_remap_shard(self, keys, values):
+        lower, upper = numpy.searchsorted(keys, [self.id_offset + 1, self.id_offset + self.max_id + 1])
+        write_mapping_shard(self.session_location + "/" + remapShardName, keys[lower:upper], values[lower:upper])
 
-    # find body mappings
-    def find_mappings(self, merge_list, substacks):
+
+    # binary merge lists of this substack's stitch jobs
+    # (decided again from the cached overlaps if they were stitched with another policy than policy)
+    def read_merge_lists(self, policy=None):
+        merge_lists = []
+        for i in range(self.num_stitch):
+            merges_file = self.session_location + "/merge_" + str(i) + ".npz"
+            merge_list = read_merge_list(merges_file)
+            if policy is not None and not numpy.array_equal(merge_list["policy"], policy):
+                redecide(json.load(open(self.session_location + "/config_stitch" + str(i) + ".json")))
+                merge_list = read_merge_list(merges_file)
+            merge_lists.append(merge_list)
+        return merge_lists
+
+    # global (larger id, smaller id) body pairs of the merge lists
+    def find_mappings(self, merge_lists, substacks):
         if self.id_offset is None:
             raise Exception("No offset specified")
-       
-        for i in range(self.num_stitch):
-            jname = self.session_location + "/merge_" + str(i) + ".json"
-            merge_data = json.load(open(jname))
-            substack2 = substacks[merge_data["id"]]
+
+        merges = [numpy.zeros((0, 2), dtype=numpy.uint64)]
+        for merge_list in merge_lists:
+            substack2 = substacks[merge_list["id"]]
 
             # first body is substack1, second body is substack2
             # put larger body id first
-            for merge in merge_data["merge_list"]:
-                body1 = merge[0] + self.id_offset
-                body2 = merge[1] + substack2.id_offset
-                if body2 > body1:
-                    body1, body2 = body2, body1
-                merge_list.append([body1, body2])
-
-    # load synapse data into local file (assume data is a unique copy)
-    def load_local_synapse_file(self, data):
-        self.synapsedata = True
-        lowerbound_in = numpy.array([self.roi.x1-self.border, self.roi.y1-self.border, self.roi.z1-self.border])
-        upperbound_ex = numpy.array([self.roi.x2+self.border, self.roi.y2+self.border, self.roi.z2+self.border])
-        dims = upperbound_ex - lowerbound_in
-
-        synapse_list = []
+            body1 = merge_list["merges"][:, 0] + numpy.uint64(self.id_offset)
+            body2 = merge_list["merges"][:, 1] + numpy.uint64(substack2.id_offset)
+            merges.append(numpy.column_stack((numpy.maximum(body1, body2), numpy.minimum(body1, body2))))
+        return numpy.concatenate(merges)
 
-        for synapse in data["data"]:
-            foundviolation = False
-
-            synapse["T-bar"]["location"] = list(numpy.array(synapse["T-bar"]["location"]) - lowerbound_in)
-
-            # check if tbar is beyond bounding box
-            vios1 = dims - numpy.array(synapse["T-bar"]["location"])
-            vios2 = numpy.array(synapse["T-bar"]["location"])
-            for iter in range(0, len(vios1)):
-                if vios2[iter] < 0 or vios1[iter] <= 0:
-                    foundviolation = True
-                    break
-            if foundviolation:
-                continue
-            # flip y to conform to raveler y format (which gala and neuroproof handle)
-            synapse["T-bar"]["location"][1] = dims[1] - synapse["T-bar"]["location"][1] - 1
-
-            # no constraints need to be added otherwise
-            if len(synapse["partners"]) == 0:
-                continue
-
-            for partner in synapse["partners"]:
-                partner["location"] = list(numpy.array(partner["location"]) - lowerbound_in)
-
-                # check if psd is beyond bounding box
-                vios1 = dims - numpy.array(partner["location"])
-                vios2 = numpy.array(partner["location"])
-                for iter in range(0, len(vios1)):
-                    if vios2[iter] < 0 or vios1[iter] <= 0:
-                        foundviolation = True
-                        break
-                if foundviolation:
-                    break
-                # flip y to conform to raveler y format (which gala and neuroproof handle)
-                partner["location"][1] = dims[1] - partner["location"][1] - 1
-                
-            if foundviolation:
-                continue
-
-            synapse_list.append(synapse)
+    # write synapses inside the substack (with border) into local file
+    def load_local_synapse_file(self, synapses):
+        self.synapsedata = True
+        lowerbound_in = [self.roi.x1-self.border, self.roi.y1-self.border, self.roi.z1-self.border]
+        upperbound_ex = [self.roi.x2+self.border, self.roi.y2+self.border, self.roi.z2+self.border]
 
-        new_data = {}
-        new_data["data"] = synapse_list
-        new_data["metadata"] = data["metadata"]
+        indices = synapses.find(lowerbound_in, upperbound_ex)
+        new_data = synapses.local_data(indices, lowerbound_in, upperbound_ex)
 
         fout = open(self.session_location + "/synapses_local.json", 'w')
         fout.write(json.dumps(new_data, indent=4))
         fout.close()
 
-    # write out configuration json and launch job
-    def launch_label_job(self, cluster_session, config):
+    # write out configuration json and create watershed task
+    def label_task(self, config):
         config["bbox1"] = [self.roi.x1, self.roi.y1, self.roi.z1]
         config["bbox2"] = [self.roi.x2, self.roi.y2, self.roi.z2]
         config["border"] = self.border
@@ -216,25 +240,64 @@ class Substack:
         fout.write(json.dumps(config, indent=4))
         fout.close()
 
-        # launch job on cluster
-        jt = cluster_session.createJobTemplate()
-        jt.remoteCommand = watershedExe
-        jt.joinFiles = True
-        jt.outputPath = ":" + self.session_location + "/watershed.out"
-
-        # use current environment, use all slots for Ilastik
-        # dvid=true
-        jt.nativeSpecification = "-pe batch 4 -j y -o /dev/null -b y -cwd -V -l dvid=true"
-        jt.args = [self.session_location, "--config-file", self.session_location + "/config.json"]
-        return cluster_session.runJob(jt)
+        # use all slots for Ilastik
+        args = [self.session_location, "--config-file", self.session_location + "/config.json"]
+        return Task("watershed " + str(self.substackid), watershedExe, args,
+                self.session_location + "/watershed.out", slots=4, dvid=True,
+                outputs=[self.session_location + "/supervoxels.h5", self.session_location + "/max_body.json"])
 
     def touches(self, p1, p2, p1_2, p2_2):
         if p1 == p2_2 or p2 == p1_2:
             return True
         return False
     
-    # launch substack stitch command
-    def launch_stitch_job(self, substack2, cluster_session, options):
+    # axis where substacks touch, across which bodies need to be examined 
+    def overlap_axis(self, substack2):
+        axis = ""
+        if self.touches(self.roi.x1, self.roi.x2, substack2.roi.x1, substack2.roi.x2):
+            axis += "x"
+        if self.touches(self.roi.y1, self.roi.y2, substack2.roi.y1, substack2.roi.y2):
+            axis += "y"
+        if self.touches(self.roi.z1, self.roi.z2, substack2.roi.z1, substack2.roi.z2):
+            axis += "z"
+        return axis
+
+    # (axis, side of this substack) of the face shared with substack2, None if they do not touch along one axis
+    def shared_face(self, substack2):
+        axis = self.overlap_axis(substack2)
+        if len(axis) != 1:
+            return None
+        if getattr(self.roi, axis + "2") == getattr(substack2.roi, axis + "1"):
+            return (axis, "high")
+        return (axis, "low")
+
+    # stitching with substack2 reads the face cache
+    def add_face(self, substack2):
+        face = self.shared_face(substack2)
+        if face is not None and face not in self.faces:
+            self.faces.append(face)
+
+    # write the faces shared with neighbors to separate files
+    def faces_task(self, options):
+        config = {}
+        config["label-format"] = options.label_format
+        config["labels"] = self.session_location + "/segmentation.h5"
+        config["bbox1"] = [self.roi.x1-self.border, self.roi.y1-self.border, self.roi.z1-self.border]
+        bbox2 = [self.roi.x2+self.border, self.roi.y2+self.border, self.roi.z2+self.border]
+        config["faces"] = []
+        for axis, side in self.faces:
+            face1, face2 = face_bbox(config["bbox1"], bbox2, self.border, axis, side)
+            config["faces"].append({"bbox1": face1, "bbox2": face2, "output": self.session_location + "/" + face_name(axis, side)})
+
+        fout = open(self.session_location + "/configf.json", 'w')
+        fout.write(json.dumps(config, indent=4))
+        fout.close()
+
+        return Task("faces " + str(self.substackid), extractFaces, [self.session_location + "/configf.json"],
+                self.session_location + "/faces.out", outputs=[face["output"] for face in config["faces"]])
+
+    # create substack stitch task
+    def stitch_task(self, substack2, options):
         config = {}
         config["bbox1"] = [self.roi.x1-self.border, self.roi.y1-self.border, self.roi.z1-self.border]
         config["bbox2"] = [self.roi.x2+self.border, self.roi.y2+self.border, self.roi.z2+self.border]
@@ -244,23 +307,26 @@ class Substack:
 
         config["labels"] = self.session_location + "/segmentation.h5"
         config["labels_2"] = substack2.session_location + "/segmentation.h5"
+
+        # only the overlap is needed, so read the cached faces if they were extracted
+        face = self.shared_face(substack2)
+        face2 = substack2.shared_face(self)
+        if face in self.faces and face2 in substack2.faces:
+            config["bbox1"], config["bbox2"] = face_bbox(config["bbox1"], config["bbox2"], self.border, *face)
+            config["bbox1_2"], config["bbox2_2"] = face_bbox(config["bbox1_2"], config["bbox2_2"], self.border, *face2)
+            config["labels"] = self.session_location + "/" + face_name(*face)
+            config["labels_2"] = substack2.session_location + "/" + face_name(*face2)
         
         configname = self.session_location + "/config_stitch" + str(self.num_stitch) + ".json"
         config["output"] = self.session_location + "/merge_" + str(self.num_stitch) + ".json"
+        config["merges"] = self.session_location + "/merge_" + str(self.num_stitch) + ".npz"
+        config["overlaps"] = self.session_location + "/overlap_" + str(self.num_stitch) + ".npz"
         config["id"] = substack2.substackid
 
         config["stitching-mode"] = options.stitch_mode
+        config["stitch-thresholds"] = options.stitch_thresholds
 
-        # axis where substacks touch, across which bodies need to be examined 
-        axis = ""
-        if self.touches(self.roi.x1, self.roi.x2, substack2.roi.x1, substack2.roi.x2):
-            axis += "x"
-        if self.touches(self.roi.y1, self.roi.y2, substack2.roi.y1, substack2.roi.y2):
-            axis += "y"
-        if self.touches(self.roi.z1, self.roi.z2, substack2.roi.z1, substack2.roi.z2):
-            axis += "z"
-
-        config["overlap-axis"] = axis
+        config["overlap-axis"] = self.overlap_axis(substack2)
 
         self.num_stitch += 1
 
@@ -268,27 +334,13 @@ class Substack:
         fout.write(json.dumps(config, indent=4))
         fout.close()
 
-        # launch job on cluster
-        jt = cluster_session.createJobTemplate()
-        jt.remoteCommand = stitchLabels 
-        jt.joinFiles = True
-        jt.outputPath = ":" + self.session_location + "/stitch_" + str(self.num_stitch - 1) + ".out"
-
-        # use current environment, need only one slot
-        jt.nativeSpecification = "-pe batch 1 -j y -o /dev/null -b y -cwd -V"
-        jt.args = [configname]
-        return cluster_session.runJob(jt)
-
-
-    def launch_compute_graph(self, cluster_session, options, graphname, labelvolname, docomputeprob):
-        # launch job on cluster
-        jt = cluster_session.createJobTemplate()
-        jt.remoteCommand = computeGraph 
-        jt.joinFiles = True
-        jt.outputPath = ":" + self.session_location + "/computegraph.out"
-        # use current environment
-        # dvid=true
-        jt.nativeSpecification = "-pe batch 4 -j y -o /dev/null -b y -cwd -V -l dvid=true"
+        # need only one slot
+        return Task("stitch " + str(self.substackid) + "-" + str(substack2.substackid), stitchLabels,
+                [configname], self.session_location + "/stitch_" + str(self.num_stitch - 1) + ".out",
+                outputs=[config["output"], config["merges"], config["overlaps"]])
+
+
+    def compute_graph_task(self, options, graphname, labelvolname, docomputeprob):
         args = ["--dvid-server", options.dvidserver, "--uuid", options.uuid, "--label-name", labelvolname, "--graph-name", graphname, "--x", str(self.roi.x1), "--y", str(self.roi.y1), "--z", str(self.roi.z1), "--xsize", str(self.roi.x2-self.roi.x1), "--ysize", str(self.roi.y2-self.roi.y1), "--zsize", str(self.roi.z2-self.roi.z1)]
 
         if options.roi != "":
@@ -306,17 +358,14 @@ class Substack:
             args.append("--dumpgraph")
             args.append("1")
 
-        jt.args = args
-        return cluster_session.runJob(jt)
+        return Task("compute-graph " + str(self.substackid), computeGraph, args,
+                self.session_location + "/computegraph.out", slots=4, dvid=True)
 
     # calculate the probability for every edge in the graph
-    def launch_compute_probs(self, cluster_session, options, vertices, graphname):
+    def compute_probs_task(self, options, bodies, graphname):
         # write out json for vertices
-        vertex_list = []
-        for vertex in vertices:
-            vertex_list.append(vertex["Id"])
         json_data = {}
-        json_data["body-list"] = vertex_list
+        json_data["body-list"] = [int(body) for body in bodies]
         fout = open(self.session_location + "/body_list.json", 'w')
         fout.write(json.dumps(json_data, indent=4))
         fout.close()
@@ -325,61 +374,42 @@ class Substack:
         h5pred = h5py.File(self.session_location + "/STACKED_prediction.h5")
         x,y,z,num_chans = h5pred["volume/predictions"].shape
 
-        # launch job on cluster
-        jt = cluster_session.createJobTemplate()
-        jt.remoteCommand = computeProb
-        jt.joinFiles = True
-        jt.outputPath = ":" + self.session_location + "/computeprob.out"
-        # use current environment, need only one slot
-        jt.nativeSpecification = "-pe batch 1 -j y -o /dev/null -b y -cwd -V"
-        jt.args = ["--dvid-server", options.dvidserver, "--uuid", options.uuid, "--bodylist-name", self.session_location + "/body_list.json", "--graph-name", graphname, "--classifier-file", options.graphclassifier, "--num-chans", str(num_chans), "--dumpfile", "1"]
-
-        return cluster_session.runJob(jt)
-
-    def launch_agglomerate(self, cluster_session, options):
-        # launch job on cluster
-        jt = cluster_session.createJobTemplate()
-        jt.remoteCommand = agglomerateGraph 
-        jt.joinFiles = True
-        jt.outputPath = ":" + self.session_location + "/agglomerate.out"
-        # use current environment, need only one slot
-        jt.nativeSpecification = "-pe batch 2 -j y -o /dev/null -b y -cwd -V"
+        # need only one slot
+        args = ["--dvid-server", options.dvidserver, "--uuid", options.uuid, "--bodylist-name", self.session_location + "/body_list.json", "--graph-name", graphname, "--classifier-file", options.graphclassifier, "--num-chans", str(num_chans), "--dumpfile", "1"]
+        return Task("compute-prob " + str(self.substackid), computeProb, args,
+                self.session_location + "/computeprob.out")
+
+    def agglomerate_task(self, options):
         args = [self.session_location + "/supervoxels.h5", self.session_location + "/STACKED_prediction.h5", options.agglomclassifier, "--output-file", self.session_location + "/segmentation.h5", "--threshold", str(options.agglom_threshold)]
        
         # add synapse file if it exists
         if self.synapsedata:
             args.append("--synapse-file")
             args.append(self.session_location + "/synapses_local.json")
-        jt.args = args
 
-        #print jt.args
-        return cluster_session.runJob(jt)
+        return Task("agglomerate " + str(self.substackid), agglomerateGraph, args,
+                self.session_location + "/agglomerate.out", slots=2,
+                outputs=[self.session_location + "/segmentation.h5"])
 
-    def launch_remap_job(self, cluster_session, config, base_location):
+    def remap_task(self, config):
         config["offset"] = self.id_offset
         config["bbox1"] = [self.roi.x1, self.roi.y1, self.roi.z1]
         config["bbox2"] = [self.roi.x2, self.roi.y2, self.roi.z2]
         config["border"] = self.border
         config["labels"] = self.session_location + "/segmentation.h5"
         config["labelsout"] = self.session_location + "/segmentation2.h5"
+        config["bodiesout"] = self.session_location + "/" + bodiesName
         
-        config["remapjson"] = base_location + "/remap.json" 
+        config["remap-shard"] = self.session_location + "/" + remapShardName
         fout = open(self.session_location + "/configr.json", 'w')
         fout.write(json.dumps(config, indent=4))
         fout.close()
 
-        # launch job on cluster
-        jt = cluster_session.createJobTemplate()
-        jt.remoteCommand = remapLabels 
-        jt.joinFiles = True
-        jt.outputPath = ":" + self.session_location + "/remap.out"
-
-        # use current environment, need only one slot
-        jt.nativeSpecification = "-pe batch 1 -j y -o /dev/null -b y -cwd -V"
-        jt.args = [self.session_location + "/configr.json"]
-        return cluster_session.runJob(jt)
+        # need only one slot
+        return Task("remap " + str(self.substackid), remapLabels, [self.session_location + "/configr.json"],
+                self.session_location + "/remap.out", outputs=[config["labelsout"], config["bodiesout"]])
 
-    def launch_write_job(self, cluster_session, config):
+    def write_task(self, config):
         config["offset"] = self.id_offset
         config["bbox1"] = [self.roi.x1, self.roi.y1, self.roi.z1]
         config["bbox2"] = [self.roi.x2, self.roi.y2, self.roi.z2]
@@ -389,22 +419,36 @@ class Substack:
         fout.write(json.dumps(config, indent=4))
         fout.close()
 
-        # launch job on cluster
-        jt = cluster_session.createJobTemplate()
-        jt.remoteCommand = commitLabels 
-        jt.joinFiles = True
-        jt.outputPath = ":" + self.session_location + "/commit.out"
+        return Task("commit " + str(self.substackid), commitLabels, [self.session_location + "/configw.json"],
+                self.session_location + "/commit.out", slots=4, dvid=True)
 
-        # use current environment, need only one slot
-        jt.nativeSpecification = "-pe batch 4 -j y -o /dev/null -b y -cwd -V -l dvid=true"
-        jt.args = [self.session_location + "/configw.json"]
-        return cluster_session.runJob(jt)
+    # remap and write to DVID in one job (segmentation2.h5 only if write-remapped is set)
+    def remap_write_task(self, config):
+        config["offset"] = self.id_offset
+        config["bbox1"] = [self.roi.x1, self.roi.y1, self.roi.z1]
+        config["bbox2"] = [self.roi.x2, self.roi.y2, self.roi.z2]
+        config["border"] = self.border
+        config["labels"] = self.session_location + "/segmentation.h5"
+        config["labelsout"] = self.session_location + "/segmentation2.h5"
+        config["bodiesout"] = self.session_location + "/" + bodiesName
+        config["remap-shard"] = self.session_location + "/" + remapShardName
+        fout = open(self.session_location + "/configrw.json", 'w')
+        fout.write(json.dumps(config, indent=4))
+        fout.close()
+
+        outputs = [config["bodiesout"]]
+        if config.get("write-remapped", False):
+            outputs.append(config["labelsout"])
+        return Task("write " + str(self.substackid), writeLabels, [self.session_location + "/configrw.json"],
+                self.session_location + "/write.out", slots=4, dvid=True, outputs=outputs)
 
 # handles messages with the outside world
 class Message:
-    def __init__(self, url):
+    def __init__(self, url, min_interval=5):
         self.url = url
         self.messagestr = ""
+        # posts from a background thread so a slow callback does not block scheduling
+        self.publisher = StatusPublisher(url, min_interval)
 
     def write_status(self, current_message=""):
         wrapped_message = "<html>"
@@ -413,56 +457,11 @@ class Message:
         if current_message != "":
             wrapped_message += "<b>Current Status: " + current_message + "</b>"
         wrapped_message += "</html>"
-        requests.post(self.url, data=wrapped_message,
-                headers={'content-type': 'text/html'})
+        self.publisher.put(wrapped_message)
 
-def wait_for_jobs(cluster_session, job_ids, message, job_desc):
-    cluster_session.synchronize(job_ids, drmaa.Session.TIMEOUT_WAIT_FOREVER, False)
-    for currjob in job_ids:
-        retval = cluster_session.wait(currjob, drmaa.Session.TIMEOUT_WAIT_FOREVER)
-        if retval.wasAborted or retval.hasCoreDump or retval.exitStatus != 0 or not retval.hasExited or retval.hasSignal:
-            raise Exception("JOB failure in " + job_desc)
-
-    return
-    
-    completed = set()
-    running = set()
-    not_completed = set(job_ids)
-    job_times = {}
-    for job_id in job_ids:
-        job_times[job_id] = 0
-
-    start_time = time.time()
-
-    while len(not_completed) > 0:
-        time.sleep(1)
-        for job_id in job_ids:
-            status = cluster_session.jobStatus(job_id)
-            if status == drmaa.JobState.DONE or status == drmaa.JobState.FAILED:
-                running.add(job_id)
-                completed.add(job_id)
-                if job_id in not_completed:
-                    not_completed.remove(job_id)
-            elif status == drmaa.JobState.RUNNING:
-                job_times[job_id] += 1
-                running.add(job_id)
-        current_message = "<b>Job description: " + job_desc + "</b><br>"
-        total_time = time.time() - start_time
-        current_message += "Job execution time: " + str(total_time) + " seconds" + "<br>"
-        current_message += "Num waiting: " + str(len(job_ids) - len(running)) + "<br>"
-        current_message += "Num running: " + str(len(running)-len(completed)) + "<br>"
-        current_message += "Num completed: " + str(len(completed)) + "<br>"
-        message.write_status(current_message)
-    
-    message.messagestr += "<b>Job description: " + job_desc + "</b><br>"
-    total_time = time.time() - start_time
-    message.messagestr += "Job execution time: " + str(total_time) + " seconds" + "<br>"
-    message.messagestr += "Num completed jobs: " + str(len(completed)) + "<br>"
-    total_val = 0
-    for jobid, val in job_times.items():
-        total_val += val
-    message.messagestr += "Average runtime per job: " + str(total_val/len(completed)) + " seconds<br>"
-    message.write_status()
+    # send last status
+    def close(self):
+        self.publisher.close()
 
 def orchestrate_labeling(options, message):
     start_time = time.time()
@@ -495,34 +494,62 @@ def orchestrate_labeling(options, message):
         yspan = y2 - y1
         zspan = z2 - z1 
 
-        # divide into substacks, create custom jsons/directories
-        xnum = num_divs(xspan, options.job_size, smallest_allowed)   
-        ynum = num_divs(yspan, options.job_size, smallest_allowed)   
-        znum = num_divs(zspan, options.job_size, smallest_allowed)   
-
-
-        # load substacks -- do check for max-1
-        for x in range(0, xnum):
-            for y in range(0, ynum):
-                for z in range(0, znum):
-                    startx = x * options.job_size + x1
-                    finishx = (x+1) * options.job_size + x1
-                    if x == (xnum-1):
-                        finishx = x2
+        if options.partition == "balanced":
+            # cost from the occupancy map (if given), otherwise from the volume
+            if options.cost_map is not None:
+                grid = occupancy_cost_grid(options.cost_map)
+            else:
+                grid = uniform_cost_grid([x1, y1, z1], [x2, y2, z2], grid_cell_size([x1, y1, z1], [x2, y2, z2], options.job_size))
+            regions = balanced_partition(grid, [x1, y1, z1], [x2, y2, z2], options.job_size**3,
+                    smallest_allowed, options.max_job_size)
+            for lower, upper, cost in regions:
+                roi = Bbox(lower[0], lower[1], lower[2], upper[0], upper[1], upper[2])
+                substacks.append(Substack(substackid, roi, options.overlap_size/2, cost))
+                substackid += 1
+        else:
+            # divide into substacks, create custom jsons/directories
+            xnum = num_divs(xspan, options.job_size, smallest_allowed)   
+            ynum = num_divs(yspan, options.job_size, smallest_allowed)   
+            znum = num_divs(zspan, options.job_size, smallest_allowed)   
+
+
+            # load substacks -- do check for max-1
+            for x in range(0, xnum):
+                for y in range(0, ynum):
+                    for z in range(0, znum):
+                        startx = x * options.job_size + x1
+                        finishx = (x+1) * options.job_size + x1
+                        if x == (xnum-1):
+                            finishx = x2
                     
-                    starty = y * options.job_size + y1
-                    finishy = (y+1) * options.job_size + y1
-                    if y == (ynum-1):
-                        finishy = y2
+                        starty = y * options.job_size + y1
+                        finishy = (y+1) * options.job_size + y1
+                        if y == (ynum-1):
+                            finishy = y2
                     
-                    startz = z * options.job_size + z1
-                    finishz = (z+1) * options.job_size + z1
-                    if z == (znum-1):
-                        finishz = z2
-
-                    roi = Bbox(startx, starty, startz, finishx, finishy, finishz)  
-                    substacks.append(Substack(substackid, roi, options.overlap_size/2))
-                    substackid += 1 
+                        startz = z * options.job_size + z1
+                        finishz = (z+1) * options.job_size + z1
+                        if z == (znum-1):
+                            finishz = z2
+
+                        roi = Bbox(startx, starty, startz, finishx, finishy, finishz)  
+                        substacks.append(Substack(substackid, roi, options.overlap_size/2))
+                        substackid += 1 
+    elif options.partition == "balanced":
+        # cost from the number of ROI blocks, regions outside of the ROI are dropped
+        r = requests.get(options.dvidserver + "/api/node/" + options.uuid + "/" + options.roi + "/roi")
+        grid = roi_cost_grid(r.json(), options.job_size)
+        lower = grid.origin
+        upper = grid.origin + numpy.array(grid.costs.shape[::-1]) * grid.cell_size
+        regions = balanced_partition(grid, lower, upper, options.job_size**3,
+                smallest_allowed, options.max_job_size, drop_empty=True)
+        for lower, upper, cost in regions:
+            # ?! ilastik doesn't support negative coordinates
+            if lower[0] < 20 or lower[1] < 20 or lower[2] < 20:
+                continue
+            roi = Bbox(lower[0], lower[1], lower[2], upper[0], upper[1], upper[2])
+            substacks.append(Substack(substackid, roi, options.overlap_size/2, cost))
+            substackid += 1
     else:
         # grab roi
         # !! manual ROIs (substack lists) can be stored in a keyvalue "roi" with key "partition"
@@ -553,22 +580,53 @@ def orchestrate_labeling(options, message):
             #if substackid == 4:
             #    break
 
-    # create drmaa session (wait for all jobs to finish for now)
-    cluster_session = drmaa.Session()
-    cluster_session.initialize()
+    # submit the most expensive substacks first (voxels if there is no estimate) to shorten the longest path
+    substacks.sort(key=lambda substack: -substack.cost)
+    for substackid, substack in enumerate(substacks):
+        substack.substackid = substackid
+
+    # incremental run: only the substacks around the changed region are segmented again
+    changed = None
+    if options.changed_bbox is not None:
+        if options.algorithm != "segment":
+            raise Exception("Incremental runs need the segment algorithm")
+        label_state = read_label_state(options.session_location, substacks)
+        changed = set(changed_substacks(substacks, options.changed_bbox[:3], options.changed_bbox[3:]))
+        message.write_status("segmenting " + str(len(changed)) + " of " + str(len(substacks)) + " substacks again")
+
+    # cluster (drmaa) or local execution
+    executor = create_executor(options.executor, options.local_slots)
+
+    # substack pairs that share a face (same pairs as testing every pair with isoverlap)
+    stitch_pairs = find_stitch_pairs(substacks)
+
+    # completed jobs are recorded so that a failed session can be resumed
+    manifest = Manifest(options.session_location)
+    if not options.resume:
+        manifest.clear()
+
+    # per-job times and resource usage, summarized per stage
+    metrics = JobMetrics(options.session_location)
+    if not options.resume:
+        metrics.clear()
+
+    # jobs only wait on the jobs they depend on -- merge consolidation is the only global barrier
+    # submission keeps at most the stage (and DVID) limit of jobs in flight and refills as jobs finish
+    scheduler = DagScheduler(executor, options.session_location, message, options.stage_limits,
+            options.resource_limits, manifest=manifest, resume=options.resume, metrics=metrics)
+    commit_jobs = [None] * len(substacks)
   
     if options.algorithm == "segment":
         # read synapse file and catch error if not there
         synapseread = False
         try:
-            # create synapse assignments if available
+            # create synapse assignments if available (parse once, bucket by substack size)
+            synapses = SynapseTable(json.load(open(options.synapses)), options.job_size)
+            synapseread = True
             for substack in substacks:
-                fin = open(options.synapses)
-                data = json.load(fin)
-                synapseread = True
                 # create local file and set synapse variable for relevant subsequent actions
                 substack.create_directory(options.session_location)
-                substack.load_local_synapse_file(data)
+                substack.load_local_synapse_file(synapses)
         except Exception, e:
             pass
         
@@ -585,59 +643,32 @@ def orchestrate_labeling(options, message):
         if options.roi != "":
             config["roi"] = options.roi
 
-        job_ids = []
-        job_num1 = 0
-        for substack in substacks:
+        # stitch jobs read the overlap faces instead of whole substacks
+        for i, j in stitch_pairs:
+            substacks[i].add_face(substacks[j])
+            substacks[j].add_face(substacks[i])
+
+        # agglomerate each substack once its watershed is done, then extract its faces
+        faces_jobs = []
+        for index, substack in enumerate(substacks):
             if not synapseread:
                 substack.create_directory(options.session_location)
-
-            # spawn cluster job -- return handler?
-            job_num1 += 1
-            job_ids.append(substack.launch_label_job(cluster_session, config))
-            
-            # might be a good change (using new -l dvid=true)
-            if len(job_ids) == 4000: 
-                wait_for_jobs(cluster_session, job_ids, message, "watershed: " + str(job_num1) + " of " + str(len(substacks)))
-                job_ids = []
-            
-            # throttling now supported
-            #time.sleep(3) # will be handled by throttled command shortly making this moot
-
-        # wait for job completion
-        if len(job_ids) > 0: 
-            wait_for_jobs(cluster_session, job_ids, message, "watershed")
-
-        # write status: 'performed watershed'
-        message.write_status("generated initial labels") 
-   
-        # launch neuroproof segmentation jobs
-        job_ids = []
-        for substack in substacks:
-            # spawn cluster job
-            job_ids.append(substack.launch_agglomerate(cluster_session, options))
-
-        # wait for job completion
-        wait_for_jobs(cluster_session, job_ids, message, "agglomerate")
-
-        # write status: 'performed watershed'
-        message.write_status("performed agglomeration") 
-
-        # launch reduce jobs and wait
-        job_ids = []
-        job_num = 0
-        
-        for i in range(0, len(substacks)-1):
-            for j in range(i+1, len(substacks)):
-                if substacks[i].isoverlap(substacks[j]):
-                    job_num += 1
-                    job_ids.append(substacks[i].launch_stitch_job(substacks[j], cluster_session, options))
-                    if len(job_ids) == 9000: 
-                        wait_for_jobs(cluster_session, job_ids, message, "stitch")
-                        job_ids = []
-        
-        # wait for job completion
-        if len(job_ids) > 0: 
-            wait_for_jobs(cluster_session, job_ids, message, "stitch")
+            if changed is not None and index not in changed:
+                # labels of the previous run are kept
+                faces_jobs.append(None)
+                continue
+            watershed_job = scheduler.add("watershed", substack.label_task(config))
+            agglomerate_job = scheduler.add("agglomerate", substack.agglomerate_task(options), [watershed_job])
+            faces_jobs.append(agglomerate_job)
+            if len(substack.faces) > 0:
+                faces_jobs[-1] = scheduler.add("extract-faces", substack.faces_task(options), [agglomerate_job])
+
+        # stitch once the faces of both substacks are written (incremental runs keep the other merge lists)
+        for i, j in stitch_pairs:
+            task = substacks[i].stitch_task(substacks[j], options)
+            if changed is None or i in changed or j in changed:
+                scheduler.add("stitch", task, [job for job in (faces_jobs[i], faces_jobs[j]) if job is not None])
+        scheduler.run()
 
         # write status: 'stitched watershed'
         message.write_status("stitched labels") 
@@ -646,40 +677,49 @@ def orchestrate_labeling(options, message):
         # ?! sets offset based on previous segmentation
         #id_offset = 160000000
         id_offset = 0
-        merge_list = []
-        for substack in substacks:
-            id_offset = substack.set_max_id(id_offset)
+        merge_arrays = []
+        all_merge_lists = []
+        # resumed sessions reuse the stitch jobs if only the policy changed
+        policy = stitch_policy({"stitching-mode": options.stitch_mode, "stitch-thresholds": options.stitch_thresholds})
+        if changed is None:
+            for substack in substacks:
+                id_offset = substack.set_max_id(id_offset)
+        else:
+            # unchanged substacks keep their ids, changed substacks get new ids
+            id_offset = allocate_offsets(substacks, changed, label_state)
         for substack in substacks:
             # find all substack labels that need to be remapped (sets the proper offset)
             # higher id first
-            substack.find_mappings(merge_list, substacks) 
-
-        # make a body2body map
-        body1body2 = {}
-        body2body1 = {}
-        for merger in merge_list:
-            # body1 -> body2
-            body1 = merger[0]
-            if merger[0] in body1body2:
-                body1 = body1body2[merger[0]]
-            body2 = merger[1]
-            if merger[1] in body1body2:
-                body2 = body1body2[merger[1]]
-
-            if body2 not in body2body1:
-                body2body1[body2] = set()
-            
-            # add body1 to body2 map
-            body2body1[body2].add(body1)
-            # add body1 -> body2 mapping
-            body1body2[body1] = body2
-
-            if body1 in body2body1:
-                for tbody in body2body1[body1]:
-                    body2body1[body2].add(tbody)
-                    body1body2[tbody] = body2
-
-        body2body = zip(body1body2.keys(), body1body2.values())
+            merge_lists = substack.read_merge_lists(policy)
+            merge_arrays.append(substack.find_mappings(merge_lists, substacks))
+            all_merge_lists.extend(merge_lists)
+
+        # merge and pruning counts of all stitch jobs
+        fout = open(options.session_location + "/" + stitchSummaryName, 'w')
+        fout.write(json.dumps(summarize_merge_lists(all_merge_lists), indent=4, sort_keys=True))
+        fout.close()
+
+        # consolidate merges -- every merged body maps to the smallest body in its set
+        merge_sets = UnionFind(id_offset + 1)
+        merge_array = numpy.concatenate([numpy.zeros((0, 2), dtype=numpy.uint64)] + merge_arrays)
+        merge_sets.union_pairs(merge_array[:,0], merge_array[:,1])
+        bodies, targets = merge_sets.mappings()
+
+        # each substack gets the mappings of its own id range
+        order = numpy.argsort(bodies, kind="mergesort")
+        bodies = bodies[order]
+        targets = targets[order]
+        if changed is None:
+            rewrite = set(range(len(substacks)))
+            for substack in substacks:
+                substack.write_remap_shard(bodies, targets)
+        else:
+            # keep the labels in DVID, only substacks with new labels are written
+            reconciliation = Reconciliation(substacks, changed, bodies, targets)
+            rewrite = set(reconciliation.rewrite)
+            for index in reconciliation.rewrite:
+                substacks[index].write_remap_shard(*reconciliation.mapping(index))
+        write_label_state(options.session_location, substacks, id_offset)
 
         # create label name type
         dataset_name = options.dvidserver + "/api/repo/"+ options.uuid + "/instance"
@@ -689,7 +729,8 @@ def orchestrate_labeling(options, message):
         req_json["dataname"] = options.labelname
         req_json["Sync"] = options.labelname + "-labelvol"
         req_str = json.dumps(req_json)
-        requests.post(dataset_name, data=req_str, headers=json_header) 
+        # DVID refuses to create an instance that already exists
+        new_instance = requests.post(dataset_name, data=req_str, headers=json_header).status_code == 200
       
         # create label vol type
         req_json = {}
@@ -702,14 +743,6 @@ def orchestrate_labeling(options, message):
         # launch relabel and write jobs and wait 
         config = {}
   
-        # write mappings to one sport and then reference in remap job
-        #config["remap"] = body2body 
-        remapdata = {}
-        remapdata["remap"] = body2body
-        foutremap = open(options.session_location + "/remap.json", 'w')
-        foutremap.write(json.dumps(remapdata, indent=4))
-        foutremap.close()
-
         config["write-location"] = options.dvidserver + "/api/node/" + options.uuid + "/" + options.labelname + "/raw/0_1_2"
         # roi working
         config["roi"] = options.roi
@@ -717,33 +750,24 @@ def orchestrate_labeling(options, message):
         config["server"] = options.dvidserver
         config["uuid"] = options.uuid
         config["labelname"] = options.labelname
-
-        # remap -- no DVID calls so can run a massive job
-        job_ids = []
-        for substack in substacks:
-            job_ids.append(substack.launch_remap_job(cluster_session, config, options.session_location))
-        wait_for_jobs(cluster_session, job_ids, message, "remap-labels: " + str(job_num) + " of " + str(len(substacks)))
-
-        # commit
-        job_ids = []
-        job_num = 0
-        for substack in substacks:
-            # spawn cluster job
-            job_num += 1
-            job_ids.append(substack.launch_write_job(cluster_session, config))
-
-            # setting -l dvid=true instead
-            if len(job_ids) == 4000: 
-                wait_for_jobs(cluster_session, job_ids, message, "write-labels: " + str(job_num) + " of " + str(len(substacks)))
-                job_ids = []
-
-        if len(job_ids) > 0: 
-            wait_for_jobs(cluster_session, job_ids, message, "write-labels: " + str(job_num) + " of " + str(len(substacks)))
-       
-        # wait for job completion
-        #wait_for_jobs(cluster_session, job_ids, message, "write-labels")
-        # write status: 'stitched watershed'
-        message.write_status("wrote labels") 
+        config["label-format"] = options.label_format
+        config["slab-memory-mb"] = options.slab_memory_mb
+        config["write-remapped"] = options.write_remapped
+        # blocks without labels are only skipped if nothing was written there before;
+        # otherwise (existing instance, incremental run) they replace previous labels
+        config["skip-empty-blocks"] = new_instance and changed is None
+
+        # previous remaps are only valid if offsets and mappings did not change
+        consolidation = hashlib.md5(json.dumps([substack.id_offset for substack in substacks]) + bodies.tostring() + targets.tostring()).hexdigest()
+        resume_remap = options.resume and changed is None and manifest.value("consolidate") == consolidation
+        manifest.mark_complete("consolidate", consolidation)
+
+        # remap each substack and write it to DVID in the same job
+        scheduler = DagScheduler(executor, options.session_location, message, options.stage_limits,
+                options.resource_limits, manifest=manifest, resume=resume_remap, metrics=metrics)
+        for index, substack in enumerate(substacks):
+            if index in rewrite:
+                commit_jobs[index] = scheduler.add("write-labels", substack.remap_write_task(config))
     else:
         for substack in substacks:
             substack.create_directory(options.session_location)
@@ -776,71 +800,72 @@ def orchestrate_labeling(options, message):
         req_str = json.dumps(req_json)
         requests.post(dataset_name, data=req_str, headers=json_header) 
        
-        job_ids = []
-        for substack in substacks:
-            # spawn cluster job
-            job_ids.append(substack.launch_compute_graph(cluster_session, options, graphname, labelvolname, doprediction))
-            # restrict with -l dvid=true
-            if len(job_ids) == 9000:
-                wait_for_jobs(cluster_session, job_ids, message, "compute-graph")
-                job_ids = []
+        # graph for a substack needs its labels and those of its neighbors in DVID
+        neighbors = [[index] for index in range(len(substacks))]
+        for i, j in stitch_pairs:
+            neighbors[i].append(j)
+            neighbors[j].append(i)
+
+        graph_substacks = set()
+        for index, substack in enumerate(substacks):
+            dependencies = [commit_jobs[index2] for index2 in neighbors[index] if commit_jobs[index2] is not None]
+            if changed is not None and len(dependencies) == 0:
+                # no new labels in or around the substack
+                continue
+            graph_substacks.add(index)
+            scheduler.add("compute-graph", substack.compute_graph_task(options, graphname, labelvolname, doprediction), dependencies)
 
-        # wait for job completion
-        if len(job_ids) > 0: 
-            wait_for_jobs(cluster_session, job_ids, message, "compute-graph")
+    # run remaining remap, commit and graph jobs
+    scheduler.run()
+    if options.algorithm == "segment":
+        message.write_status("wrote labels") 
 
+    if not options.labelname.endswith("nograph"):
         # only compute probs if this was a segmentation run
         if doprediction:
-            # handle prob calc (grab entire graph, create body lists, parse number of channels from ILP)
-            r = requests.get(options.dvidserver + "/api/node/" + options.uuid + "/" + graphname + "/subgraph") 
-            complete_graph = r.json()
-           
-            # find channels from ILP
-
-            # retrieve all vertices
-            import random
-            vertices = complete_graph["Vertices"]
-            random.shuffle(vertices)
-            incr = len(vertices) / len(substacks) + 1
-            start = 0
-
-            job_ids = []
-            for substack in substacks:
-                # choose random set of vertices
-                # spawn cluster job for computing probs
-                job_ids.append(substack.launch_compute_probs(cluster_session, options, vertices[start:start+incr], graphname))
-                #time.sleep(10) # not sure why I need to delay this but it is taking a long time so there must be a lot of contention 
-                start += incr
-                if len(job_ids) == 10:
-                    wait_for_jobs(cluster_session, job_ids, message, "compute-prob")
-                    job_ids = []
-
-            if len(job_ids) > 0: 
-                # wait for job completion
-                wait_for_jobs(cluster_session, job_ids, message, "compute-prob")
+            # handle prob calc -- each substack gets the bodies that mostly lie in it
+            # (the body sizes written by remap list every vertex, so the graph is not fetched)
+            body_lists = assign_bodies([substack.session_location + "/" + bodiesName for substack in substacks])
+
+            # not sure why this needs a small limit but there must be a lot of contention 
+            scheduler = DagScheduler(executor, options.session_location, message, options.stage_limits,
+                    options.resource_limits, manifest=manifest, metrics=metrics)
+            for index, (substack, bodies) in enumerate(zip(substacks, body_lists)):
+                if len(bodies) > 0 and index in graph_substacks:
+                    scheduler.add("compute-prob", substack.compute_probs_task(options, bodies, graphname))
+            scheduler.run()
 
     # calculate time
     total_time = time.time() - start_time
 
     # write status: 'finished'
+    message.messagestr += metrics.summary_html()
     message.write_status("<b>Successfully finished in " + str(total_time) + " seconds</b>") 
-    cluster_session.exit()
+    executor.exit()
    
 #parses information in config json, assume classifier and json location given directory
 def execute(args):
     parser = argparse.ArgumentParser(description="Orchestrate map/reduce-like segmentation jobs")
     parser.add_argument('session_location', type=str, help="Location of directory that contains classifier and configuration json")
+    parser.add_argument('--resume', action='store_true', help="Only run jobs that did not complete in a previous run of this session")
+    parser.add_argument('--changed-bbox', type=int, nargs=6, default=None, metavar=("X1", "Y1", "Z1", "X2", "Y2", "Z2"),
+            help="Segment only the substacks that intersect [X1, X2) x [Y1, Y2) x [Z1, Z2) again (after a complete run of this session)")
     args = parser.parse_args()
+    if args.resume and args.changed_bbox is not None:
+        parser.error("--changed-bbox cannot be combined with --resume")
 
 
     config_data = json.load(open(args.session_location + "/" + jsonName))
      
     options = CommandOptions(config_data, args.session_location)
-    message = Message(options.callback)
+    options.resume = args.resume
+    options.changed_bbox = args.changed_bbox
+    message = Message(options.callback, options.status_interval)
     try:
         orchestrate_labeling(options, message)
     except Exception, e:
         print e
         print traceback.print_exc(file=sys.stdout)
         message.write_status("FAIL: " + str(e))
+    message.close()
 
@@ -0,0 +1,120 @@
+import resource
+import time
+import zlib
+import numpy
+import requests
+from requests.adapters import HTTPAdapter
+
+"""
+Block-aligned label writer for DVID labelblk instances.
+
+A label volume is cut at DVID block (32^3) boundaries and every row of
+blocks along x is posted as runs of consecutive blocks.  Blocks that are
+all zero can be skipped when nothing was written there before (a new label
+instance is already zero there).  Payloads are gzip compressed and posted through one pooled
+HTTP session with throttling; requests that DVID rejects as busy (503) are
+retried.
+"""
+
+BLOCK_SIZE = 32
+
+# report peak resident memory of a write job (ru_maxrss is in KB on linux)
+def print_peak_memory():
+    peak_self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print "Peak memory (MB): ", peak_self / 1024.0
+
+# block boundaries (local indices) of [start, start+length) at multiples of BLOCK_SIZE
+def block_bounds(start, length):
+    first = (start // BLOCK_SIZE + 1) * BLOCK_SIZE
+    return [0] + range(first - start, length, BLOCK_SIZE) + [length]
+
+# (z, y, x) bounds along each axis and which blocks contain a label
+def block_occupancy(labels, offset):
+    bounds = [block_bounds(offset[2 - axis], labels.shape[axis]) for axis in range(3)]
+    occupied = labels != 0
+    for axis in range(3):
+        if labels.shape[axis] == 0:
+            return bounds, numpy.zeros([len(bound) - 1 for bound in bounds], dtype=bool)
+        occupied = numpy.logical_or.reduceat(occupied, bounds[axis][:-1], axis=axis)
+    return bounds, occupied
+
+# [(z1, z2, y1, y2, x1, x2)] local regions of consecutive occupied blocks along x
+def block_runs(bounds, occupied):
+    runs = []
+    for bz in range(occupied.shape[0]):
+        for by in range(occupied.shape[1]):
+            row = numpy.concatenate(([False], occupied[bz, by], [False]))
+            changes = numpy.flatnonzero(row[1:] != row[:-1])
+            for start, end in zip(changes[::2], changes[1::2]):
+                runs.append((bounds[0][bz], bounds[0][bz+1], bounds[1][by], bounds[1][by+1],
+                    bounds[2][start], bounds[2][end]))
+    return runs
+
+def gzip_compress(data):
+    compressor = zlib.compressobj(1, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+class LabelWriter:
+    def __init__(self, server, uuid, labelname, roi="", compression="gzip", throttle=True,
+            max_tries=100, retry_wait=1, pool_size=4):
+        self.url = server + "/api/node/" + uuid + "/" + labelname + "/raw/0_1_2"
+        self.roi = roi
+        self.compression = compression
+        self.throttle = throttle
+        self.max_tries = max_tries
+        self.retry_wait = retry_wait
+
+        # connections are reused across posts
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=3)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.num_posts = 0
+        self.num_tries = 0
+        self.bytes_sent = 0
+
+    # post labels (z, y, x) at voxel offset (x, y, z)
+    def post(self, labels, offset):
+        sizes = labels.shape[::-1]
+        location = self.url + "/{sx}_{sy}_{sz}/{x}_{y}_{z}".format(sx=sizes[0], sy=sizes[1], sz=sizes[2],
+                x=offset[0], y=offset[1], z=offset[2])
+        query = []
+        if self.throttle:
+            query.append("throttle=on")
+        if self.roi != "":
+            query.append("roi=" + self.roi)
+        if self.compression == "gzip":
+            query.append("compression=gzip")
+        if len(query) > 0:
+            location += "?" + "&".join(query)
+
+        data = numpy.ascontiguousarray(labels, dtype='<u8').tostring()
+        if self.compression == "gzip":
+            data = gzip_compress(data)
+
+        for tries in range(self.max_tries):
+            self.num_tries += 1
+            r = self.session.post(location, data=data, headers={'content-type': 'application/octet-stream'})
+            if r.status_code == 200:
+                self.num_posts += 1
+                self.bytes_sent += len(data)
+                return
+            if r.status_code != 503:
+                raise Exception("Write to " + location + " failed: " + str(r.status_code) + " " + r.text)
+            # DVID is busy
+            time.sleep(self.retry_wait)
+        raise Exception("Write to " + location + " failed: DVID busy after " + str(self.max_tries) + " tries")
+
+    # write labels (z, y, x) at voxel offset (x, y, z), returns number of blocks written and skipped
+    # (skip_empty only when nothing was written there before, e.g. a new label instance)
+    def write(self, labels, offset, skip_empty=False):
+        bounds, occupied = block_occupancy(labels, offset)
+        if not skip_empty:
+            occupied[...] = True
+
+        for z1, z2, y1, y2, x1, x2 in block_runs(bounds, occupied):
+            self.post(labels[z1:z2, y1:y2, x1:x2], (offset[0] + x1, offset[1] + y1, offset[2] + z1))
+
+        num_written = int(occupied.sum())
+        return num_written, occupied.size - num_written
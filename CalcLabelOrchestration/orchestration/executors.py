@@ -0,0 +1,142 @@
+import multiprocessing
+import resource
+import time
+from collections import OrderedDict
+from orchestration.job_array import launch_job_array, write_tasks_file, run_task
+
+"""
+Execution backends for pipeline tasks.
+
+Both backends take a list of tasks (see job_array.Task) and return job ids
+that are later reported back as JobResults:
+
+DrmaaExecutor -- submits each list of tasks as an SGE job array
+LocalExecutor -- runs tasks on this machine with a concurrent.futures
+process pool, starting a task only when enough of the local slots are free
+for its slot count (-pe batch N on the cluster)
+"""
+
+# run a task in a pool process, returns exit status and resource usage in the DRMAA format
+def run_timed_task(tasks_file, task_index):
+    start_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start_time = time.time()
+    exit_status = run_task(tasks_file, task_index)
+    end_time = time.time()
+    end_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    usage = {}
+    usage["start_time"] = start_time
+    usage["end_time"] = end_time
+    usage["ru_wallclock"] = end_time - start_time
+    usage["cpu"] = (end_usage.ru_utime + end_usage.ru_stime) - (start_usage.ru_utime + start_usage.ru_stime)
+    return exit_status, usage
+
+# outcome of one job
+class JobResult:
+    def __init__(self, job_id, success, exit_status, resource_usage=None):
+        self.job_id = job_id
+        self.success = success
+        self.exit_status = exit_status
+        self.resource_usage = resource_usage
+        if self.resource_usage is None:
+            self.resource_usage = {}
+
+class DrmaaExecutor:
+    def __init__(self):
+        # only needed (and only available) with a cluster
+        import drmaa
+        self.drmaa = drmaa
+        self.session = drmaa.Session()
+        self.session.initialize()
+
+    # submit tasks as one job array, returns job ids
+    def submit(self, tasks, tasks_file):
+        return launch_job_array(self.session, tasks, tasks_file)
+
+    def result(self, retval):
+        success = not (retval.wasAborted or retval.hasCoreDump or retval.exitStatus != 0 or not retval.hasExited or retval.hasSignal)
+        return JobResult(retval.jobId, success, retval.exitStatus, retval.resourceUsage)
+
+    # return result of any finished job or None after timeout seconds (0 does not wait)
+    def wait_any(self, timeout):
+        try:
+            retval = self.session.wait(self.drmaa.Session.JOB_IDS_SESSION_ANY, timeout)
+        except self.drmaa.ExitTimeoutException:
+            return None
+        return self.result(retval)
+
+    def exit(self):
+        self.session.exit()
+
+class LocalExecutor:
+    def __init__(self, max_slots=None):
+        from concurrent import futures
+        self.futures = futures
+        if max_slots is None:
+            max_slots = multiprocessing.cpu_count()
+        self.max_slots = max_slots
+        self.pool = futures.ProcessPoolExecutor(max_workers=max_slots)
+
+        # (job id, tasks file, task index, slots) in submission order
+        self.queued = []
+        # future -> (job id, slots)
+        self.running = {}
+        self.used_slots = 0
+        # finished jobs that have not been reported
+        self.results = OrderedDict()
+        self.num_jobs = 0
+
+    # queue tasks (run in submission order), returns job ids
+    def submit(self, tasks, tasks_file):
+        write_tasks_file(tasks, tasks_file)
+        job_ids = []
+        for index, task in enumerate(tasks):
+            job_id = "local." + str(self.num_jobs)
+            self.num_jobs += 1
+            # a task larger than the machine runs by itself
+            self.queued.append((job_id, tasks_file, index + 1, min(task.slots, self.max_slots)))
+            job_ids.append(job_id)
+        self.start_queued()
+        return job_ids
+
+    # start queued tasks while there are enough free slots
+    def start_queued(self):
+        while len(self.queued) > 0 and self.used_slots + self.queued[0][3] <= self.max_slots:
+            job_id, tasks_file, task_index, slots = self.queued.pop(0)
+            future = self.pool.submit(run_timed_task, tasks_file, task_index)
+            self.running[future] = (job_id, slots)
+            self.used_slots += slots
+
+    # wait up to timeout seconds (None waits forever) for running tasks to finish
+    def collect(self, timeout):
+        if len(self.running) == 0:
+            return
+        done, not_done = self.futures.wait(self.running.keys(), timeout=timeout, return_when=self.futures.FIRST_COMPLETED)
+        for future in done:
+            job_id, slots = self.running.pop(future)
+            self.used_slots -= slots
+            try:
+                exit_status, usage = future.result()
+            except Exception, e:
+                exit_status, usage = 1, None
+            self.results[job_id] = JobResult(job_id, exit_status == 0, exit_status, usage)
+        self.start_queued()
+
+    # return result of any finished job or None after timeout seconds (0 does not wait)
+    def wait_any(self, timeout):
+        if len(self.results) == 0:
+            self.collect(timeout)
+        if len(self.results) == 0:
+            return None
+        return self.results.popitem(last=False)[1]
+
+    def exit(self):
+        self.pool.shutdown()
+
+# executor named in the session configuration
+def create_executor(name, max_slots=None):
+    if name == "drmaa":
+        return DrmaaExecutor()
+    if name == "local":
+        return LocalExecutor(max_slots)
+    raise Exception("Unknown executor: " + name)
@@ -0,0 +1,41 @@
+import argparse
+import json
+from orchestration.label_io import read_labels, write_labels
+
+"""
+Boundary-face cache for stitching.
+
+After agglomeration every substack writes the slabs of its labels that
+overlap its neighbors (the 2*border thick face along each touching side)
+into small per-face files.  Stitch jobs read the two faces instead of both
+full segmentation volumes.
+"""
+
+# name of the face file for a side ("x", "y" or "z" and "low" or "high")
+def face_name(axis, side):
+    return "face_" + axis + side + ".h5"
+
+# bounding box [bbox1, bbox2) of a face given the substack bounding box with border
+def face_bbox(bbox1, bbox2, border, axis, side):
+    index = "xyz".index(axis)
+    face1 = list(bbox1)
+    face2 = list(bbox2)
+    if side == "low":
+        face2[index] = bbox1[index] + 2*border
+    else:
+        face1[index] = bbox2[index] - 2*border
+    return face1, face2
+
+def execute(argv):
+    parser = argparse.ArgumentParser(description="Writes the overlap faces of a label volume")
+    parser.add_argument('config_file', type=str, help="Location of configuration json")
+    args = parser.parse_args()
+
+    json_data = json.load(open(args.config_file))
+    bbox1 = json_data["bbox1"]
+
+    for face in json_data["faces"]:
+        start = [val1 - val2 for val1, val2 in zip(face["bbox1"], bbox1)]
+        end = [val1 - val2 for val1, val2 in zip(face["bbox2"], bbox1)]
+        face_labels = read_labels(json_data["labels"], (slice(start[2], end[2]), slice(start[1], end[1]), slice(start[0], end[0])))
+        write_labels(face["output"], face_labels, json_data.get("label-format"))
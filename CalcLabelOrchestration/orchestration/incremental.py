@@ -0,0 +1,186 @@
+import json
+import os
+import numpy
+from orchestration.relabel import apply_mapping, read_mapping_shard, remapShardName
+from orchestration.unionfind import UnionFind
+
+"""
+Incremental re-segmentation of a changed region of a session.
+
+Every full consolidation records the partition and the global id offset of
+each substack in labelStateName.  An incremental run (calclabels_cluster
+--changed-bbox) repeats watershed and agglomeration only for the substacks
+whose region with border intersects the changed bounding box.  It then
+re-stitches only the pairs that involve one of these substacks.
+
+IDs are reconciled with the labels already in DVID:
+
+* The re-segmented substacks get new id ranges after the largest id used
+  so far, so their new bodies never collide with existing labels.
+* The other substacks keep their offsets and remap shards.
+* Merged sets that contain bodies with the same existing final label are
+  joined, together with every other body of an unchanged substack that has
+  this label.  A joined class takes the smallest existing label among its
+  bodies; sets without unchanged bodies take their smallest id.
+* Bodies of unchanged substacks keep their final label unless the new
+  merges join them to a body with a smaller existing label.  Existing
+  merges are never split, also when they were only made through a body of
+  a re-segmented substack.
+
+Only the re-segmented substacks and the unchanged substacks with
+relabeled bodies are written to DVID again.
+"""
+
+labelStateName = "label_state.json"
+
+def substack_bounds(substack):
+    roi = substack.roi
+    return [roi.x1, roi.y1, roi.z1, roi.x2, roi.y2, roi.z2]
+
+# offsets and partition of the last consolidation
+def write_label_state(session_location, substacks, max_id):
+    state = {"substacks": [substack_bounds(substack) for substack in substacks],
+            "offsets": [substack.id_offset for substack in substacks], "max-id": max_id}
+    fout = open(session_location + "/" + labelStateName, 'w')
+    fout.write(json.dumps(state))
+    fout.close()
+
+def read_label_state(session_location, substacks):
+    filename = session_location + "/" + labelStateName
+    if not os.path.exists(filename):
+        raise Exception("No labels from a previous run in " + session_location)
+    state = json.load(open(filename))
+    if state["substacks"] != [substack_bounds(substack) for substack in substacks]:
+        raise Exception("Partition differs from the previous run of " + session_location)
+    return state
+
+# indices of the substacks whose region with border intersects [bbox1, bbox2) (x, y, z)
+def changed_substacks(substacks, bbox1, bbox2):
+    changed = []
+    for index, substack in enumerate(substacks):
+        bounds = substack_bounds(substack)
+        lower = [val - substack.border for val in bounds[:3]]
+        upper = [val + substack.border for val in bounds[3:]]
+        if all([lower[axis] < bbox2[axis] and bbox1[axis] < upper[axis] for axis in range(3)]):
+            changed.append(index)
+    return changed
+
+# unchanged substacks keep their offsets, changed substacks get new ids after max_id, returns the new max id
+def allocate_offsets(substacks, changed, state):
+    id_offset = state["max-id"]
+    for index, substack in enumerate(substacks):
+        if index in changed:
+            id_offset = substack.set_max_id(id_offset)
+        else:
+            substack.set_max_id(state["offsets"][index])
+    return id_offset
+
+# substack index of every global id (-1 for 0)
+def id_substacks(ids, substacks):
+    starts = numpy.array([substack.id_offset for substack in substacks], dtype=numpy.uint64)
+    # substacks without ids share their offset with the next one and go first
+    order = numpy.lexsort(([substack.max_id for substack in substacks], starts))
+    index = numpy.searchsorted(starts[order], ids, side="left") - 1
+    result = order[numpy.maximum(index, 0)]
+    result[ids == 0] = -1
+    return result
+
+# which ids are bodies of an unchanged substack (ids in the previous range
+# of a changed substack do not belong to any substack now)
+def is_body(ids, ids_substacks, substacks, changed):
+    lower = numpy.array([substack.id_offset for substack in substacks], dtype=numpy.uint64)
+    upper = lower + numpy.array([substack.max_id for substack in substacks], dtype=numpy.uint64)
+    index = numpy.maximum(ids_substacks, 0)
+    unchanged = numpy.array([index not in changed for index in ids_substacks.tolist()], dtype=bool)
+    return unchanged & (ids_substacks >= 0) & (ids > lower[index]) & (ids <= upper[index])
+
+class Reconciliation:
+    # bodies, targets: consolidated merges (every body to the smallest id of its set)
+    def __init__(self, substacks, changed, bodies, targets):
+        self.substacks = substacks
+        self.changed = set(changed)
+        unchanged = [index for index in range(len(substacks)) if index not in self.changed]
+
+        # existing final labels of the unchanged substacks
+        keys = [numpy.zeros(0, dtype=numpy.uint64)]
+        values = [numpy.zeros(0, dtype=numpy.uint64)]
+        for index in unchanged:
+            shard_keys, shard_values = read_mapping_shard(substacks[index].session_location + "/" + remapShardName)
+            keys.append(numpy.array(shard_keys))
+            values.append(numpy.array(shard_values))
+        keys = numpy.concatenate(keys)
+        order = numpy.argsort(keys, kind="mergesort")
+        self.old_keys = keys[order]
+        self.old_values = numpy.concatenate(values)[order]
+
+        # every member of a merged set and the smallest id of its set
+        sets = numpy.unique(targets)
+        members = numpy.concatenate((bodies, sets)).astype(numpy.uint64)
+        member_sets = numpy.concatenate((targets, sets)).astype(numpy.uint64)
+        member_substacks = id_substacks(members, substacks)
+        is_unchanged = numpy.array([index not in self.changed for index in member_substacks.tolist()], dtype=bool)
+
+        # sets that share an existing label are joined, so existing merges are kept
+        old_labels = apply_mapping(members, self.old_keys, self.old_values)
+        set_index = numpy.searchsorted(sets, member_sets)
+        labels = numpy.unique(numpy.concatenate((old_labels[is_unchanged], self.old_values)))
+        label_index = numpy.searchsorted(labels, old_labels[is_unchanged]) + len(sets)
+        classes = UnionFind(len(sets) + len(labels))
+        classes.union_pairs(set_index[is_unchanged], label_index)
+        set_class = classes.parent[:len(sets)]
+        label_class = classes.parent[len(sets):]
+
+        # label of a class: its smallest existing label, otherwise the smallest id of its sets
+        none = numpy.iinfo(numpy.uint64).max
+        best_label = numpy.full(len(sets) + len(labels), none, dtype=numpy.uint64)
+        numpy.minimum.at(best_label, label_class, labels)
+        best_set = numpy.full(len(sets) + len(labels), none, dtype=numpy.uint64)
+        numpy.minimum.at(best_set, set_class, sets)
+        class_labels = numpy.where(best_label != none, best_label, best_set)
+        member_labels = class_labels[set_class[set_index]]
+
+        # a relabeled existing label is also the id of a body of an unchanged substack
+        # (not in a shard, since it maps to itself) that has to move with its class
+        label_values = class_labels[label_class]
+        label_substacks = id_substacks(labels, substacks)
+        label_bodies = (label_values != labels) & is_body(labels, label_substacks, substacks, self.changed)
+        label_bodies &= ~numpy.isin(labels, members)
+
+        keys = numpy.concatenate((members, labels[label_bodies]))
+        values = numpy.concatenate((member_labels, label_values[label_bodies]))
+        order = numpy.argsort(keys, kind="mergesort")
+        self.keys = keys[order]
+        self.values = values[order]
+
+        # bodies outside the merged sets follow their existing label
+        new_values = label_values[numpy.searchsorted(labels, self.old_values)]
+        moved = new_values != self.old_values
+        self.old_values = new_values
+
+        # unchanged substacks with relabeled bodies are written again
+        relabeled = is_unchanged & (member_labels != old_labels)
+        rewrite = set(member_substacks[relabeled].tolist())
+        rewrite.update(id_substacks(self.old_keys[moved], substacks).tolist())
+        rewrite.update(label_substacks[label_bodies].tolist())
+        self.rewrite = sorted(rewrite | self.changed)
+
+    # sorted keys and values of the final labels of a substack's id range
+    def mapping(self, index):
+        substack = self.substacks[index]
+        lower, upper = substack.id_offset + 1, substack.id_offset + substack.max_id + 1
+        start, end = numpy.searchsorted(self.keys, [lower, upper])
+        keys = [self.keys[start:end]]
+        values = [self.values[start:end]]
+        if index not in self.changed:
+            # existing labels of bodies that are not in a merged set
+            start, end = numpy.searchsorted(self.old_keys, [lower, upper])
+            keys.append(self.old_keys[start:end])
+            values.append(self.old_values[start:end])
+        keys = numpy.concatenate(keys)
+        values = numpy.concatenate(values)
+
+        # new labels take precedence
+        keys, first = numpy.unique(keys, return_index=True)
+        values = values[first]
+        keep = keys != values
+        return keys[keep], values[keep]
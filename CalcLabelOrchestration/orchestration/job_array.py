@@ -0,0 +1,86 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+"""
+Task descriptions for cluster job arrays.
+
+The orchestrator writes the tasks of one stage to a json file and submits
+them as a single SGE job array.  Every array task runs 'run_task' with that
+file, picks its entry by task index (SGE_TASK_ID) and runs the stage
+command with its output redirected to the per-substack log.
+"""
+
+runTask = "run_task"
+
+# command for one substack (or substack pair) in a stage
+class Task:
+    def __init__(self, name, command, args, output, slots=1, dvid=False, outputs=[]):
+        self.name = name
+        self.command = command
+        self.args = args
+        self.output = output
+        # number of slots (-pe batch) and whether the job talks to DVID (-l dvid=true)
+        self.slots = slots
+        self.dvid = dvid
+        # files written by the task (checked when resuming)
+        self.outputs = outputs
+
+    def to_json(self):
+        return {"name": self.name, "command": self.command, "args": self.args, "output": self.output}
+
+# scheduler options for a set of tasks (use current environment)
+def native_specification(slots, dvid):
+    spec = "-pe batch " + str(slots) + " -j y -o /dev/null -b y -cwd -V"
+    if dvid:
+        spec += " -l dvid=true"
+    return spec
+
+# write task list read by each task of the array
+def write_tasks_file(tasks, filename):
+    fout = open(filename, 'w')
+    fout.write(json.dumps([task.to_json() for task in tasks], indent=4))
+    fout.close()
+
+# submit tasks as one job array (all tasks must use the same slots and resources)
+def launch_job_array(cluster_session, tasks, tasks_file):
+    write_tasks_file(tasks, tasks_file)
+
+    jt = cluster_session.createJobTemplate()
+    jt.remoteCommand = runTask
+    jt.args = [tasks_file]
+    jt.joinFiles = True
+    # each task writes its own output file
+    jt.outputPath = ":/dev/null"
+    jt.nativeSpecification = native_specification(tasks[0].slots, tasks[0].dvid)
+
+    job_ids = cluster_session.runBulkJobs(jt, 1, len(tasks), 1)
+    cluster_session.deleteJobTemplate(jt)
+    return job_ids
+
+# run one task of an array (task index starts at 1)
+def run_task(tasks_file, task_index):
+    tasks = json.load(open(tasks_file))
+    task = tasks[task_index - 1]
+
+    fout = open(task["output"], 'w')
+    try:
+        return subprocess.call([task["command"]] + task["args"], stdout=fout, stderr=subprocess.STDOUT)
+    except Exception, e:
+        fout.write("Could not run " + task["command"] + ": " + str(e) + "\n")
+        return 1
+    finally:
+        fout.close()
+
+def execute(argv):
+    parser = argparse.ArgumentParser(description="Runs one task of a job array")
+    parser.add_argument('tasks_file', type=str, help="Location of task list json")
+    parser.add_argument('task_index', type=int, nargs='?', default=None, help="Task to run (default: SGE_TASK_ID)")
+    args = parser.parse_args()
+
+    task_index = args.task_index
+    if task_index is None:
+        task_index = int(os.environ["SGE_TASK_ID"])
+    sys.exit(run_task(args.tasks_file, task_index))
@@ -0,0 +1,91 @@
+import h5py
+import numpy
+
+"""
+Storage format for intermediate label volumes.
+
+Label volumes written by the orchestration stages (remapped labels, overlap
+faces) are stored as the "stack" dataset (z, y, x) of an HDF5 file with the
+narrowest unsigned type that holds the largest label, split into chunks of
+DVID block size and compressed with a fast filter, so partial reads (overlap
+slabs, cropped cores) only touch the chunks they need.  The format is
+configured by the session's "label-format" settings:
+
+compression -- "lzf" (default), "gzip" or "none"
+compression-level -- gzip level (default 1)
+chunk-size -- chunk edge in voxels (default 32, the DVID block size)
+
+Volumes written by other tools (e.g., segmentation.h5) are read the same way.
+"""
+
+DEFAULT_FORMAT = {"compression": "lzf", "compression-level": 1, "chunk-size": 32}
+
+# smallest unsigned type that can hold the largest label
+def narrow_dtype(max_label):
+    for dtype in (numpy.uint8, numpy.uint16, numpy.uint32):
+        if max_label <= numpy.iinfo(dtype).max:
+            return dtype
+    return numpy.uint64
+
+# chunk shape (no larger than the volume), None for empty volumes
+def chunk_shape(shape, chunk_size):
+    if len(shape) == 0 or min(shape) == 0:
+        return None
+    return tuple([min(chunk_size, dim) for dim in shape])
+
+# chunk and compression settings of the "stack" dataset
+def dataset_options(shape, label_format=None):
+    settings = dict(DEFAULT_FORMAT)
+    if label_format is not None:
+        settings.update(label_format)
+
+    compression = settings["compression"]
+    compression_opts = None
+    if compression == "none":
+        compression = None
+    elif compression == "gzip":
+        compression_opts = settings["compression-level"]
+    chunks = chunk_shape(shape, settings["chunk-size"])
+    if chunks is None:
+        compression = compression_opts = None
+    return {"chunks": chunks, "compression": compression, "compression_opts": compression_opts}
+
+def write_labels(filename, labels, label_format=None):
+    max_label = 0
+    if labels.size > 0:
+        max_label = int(labels.max())
+    labels = labels.astype(narrow_dtype(max_label), copy=False)
+
+    fout = h5py.File(filename, 'w')
+    fout.create_dataset("stack", data=labels, **dataset_options(labels.shape, label_format))
+    fout.close()
+
+# empty label volume that is written in parts, returns the file and the dataset
+def create_labels(filename, shape, max_label, label_format=None):
+    fout = h5py.File(filename, 'w')
+    dset = fout.create_dataset("stack", shape, dtype=narrow_dtype(max_label), **dataset_options(shape, label_format))
+    return fout, dset
+
+def label_shape(filename):
+    hfile = h5py.File(filename, 'r')
+    shape = hfile['stack'].shape
+    hfile.close()
+    return shape
+
+# read all labels or a region (tuple of slices), optionally converted to dtype
+def read_labels(filename, region=None, dtype=None):
+    hfile = h5py.File(filename, 'r')
+    dset = hfile['stack']
+    if region is None and dtype is not None:
+        # read straight into a buffer of the requested type
+        labels = numpy.empty(dset.shape, dtype=dtype)
+        if labels.size > 0:
+            dset.read_direct(labels)
+    else:
+        if region is None:
+            region = Ellipsis
+        labels = numpy.array(dset[region])
+        if dtype is not None:
+            labels = labels.astype(dtype, copy=False)
+    hfile.close()
+    return labels
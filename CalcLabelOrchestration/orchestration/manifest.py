@@ -0,0 +1,64 @@
+import json
+import os
+import time
+import h5py
+
+"""
+Persistent record of completed jobs for resuming a session.
+
+Every successful job appends one json line (job name and an optional value)
+to the manifest in the session directory.  On resume a job is skipped only
+if it is recorded as complete, its output files are still valid and none
+of the jobs it depends on had to be rerun.
+"""
+
+manifestName = "manifest.jsonl"
+
+class Manifest:
+    def __init__(self, session_location):
+        self.filename = session_location + "/" + manifestName
+        self.completed = {}
+        if os.path.exists(self.filename):
+            for line in open(self.filename):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # partially written last line
+                    continue
+                self.completed[entry["name"]] = entry.get("value")
+
+    # forget all completed jobs (fresh run)
+    def clear(self):
+        self.completed = {}
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def is_complete(self, name):
+        return name in self.completed
+
+    def value(self, name):
+        return self.completed.get(name)
+
+    def mark_complete(self, name, value=None):
+        self.completed[name] = value
+        fout = open(self.filename, 'a')
+        fout.write(json.dumps({"name": name, "value": value, "time": time.time()}) + "\n")
+        fout.close()
+
+# check that output files exist and can be read
+def outputs_valid(filenames):
+    for filename in filenames:
+        if not os.path.exists(filename):
+            return False
+        try:
+            if filename.endswith(".h5"):
+                hfile = h5py.File(filename, 'r')
+                valid = len(hfile.keys()) > 0
+                hfile.close()
+                if not valid:
+                    return False
+            elif filename.endswith(".json"):
+                json.load(open(filename))
+        except Exception, e:
+            return False
+    return True
@@ -0,0 +1,53 @@
+import numpy
+
+"""
+Binary merge lists written by stitch jobs.
+
+Besides merge_N.json, every stitch job writes merge_N.npz with its merges
+as one (n, 2) array of local (body1, body2) ids, the overlap of each merged
+pair and the total overlap of both bodies, the counts of candidates pruned
+by each rule, the stitching policy (mode and thresholds) and the id of the
+second substack.  Consolidation reads the
+arrays of every stitch job instead of parsing the json lists and writes the
+totals of the statistics to stitchSummaryName in the session directory.
+"""
+
+stitchSummaryName = "stitch_summary.json"
+
+# candidate counts kept by stitch jobs (in stitch_labels order)
+pruneStats = ["small-overlap-prune", "conservative-prune", "aggressive-add", "not-mutual"]
+
+# merges: [[body1, body2]], overlaps/totals1/totals2 per merge, stats: name -> count, policy: numbers
+def write_merge_list(filename, substack2, merges, overlaps, totals1, totals2, stats, policy):
+    numpy.savez(filename, id=numpy.int64(substack2),
+            merges=numpy.array(merges, dtype=numpy.uint64).reshape(-1, 2),
+            overlaps=numpy.array(overlaps, dtype=numpy.int64),
+            totals1=numpy.array(totals1, dtype=numpy.int64),
+            totals2=numpy.array(totals2, dtype=numpy.int64),
+            stats=numpy.array([stats[name] for name in pruneStats], dtype=numpy.int64),
+            policy=numpy.array(policy, dtype=numpy.float64))
+
+# dict of the arrays of a merge list ("id" is an int)
+def read_merge_list(filename):
+    data = numpy.load(filename)
+    merge_list = dict([(name, data[name]) for name in data.files])
+    data.close()
+    merge_list["id"] = int(merge_list["id"])
+    return merge_list
+
+# totals of the merge list statistics of all stitch jobs
+def summarize_merge_lists(merge_lists):
+    summary = dict([(name, 0) for name in pruneStats])
+    summary["stitch-jobs"] = len(merge_lists)
+    summary["merges"] = 0
+    overlaps = []
+    for merge_list in merge_lists:
+        for name, count in zip(pruneStats, merge_list["stats"].tolist()):
+            summary[name] += count
+        summary["merges"] += len(merge_list["merges"])
+        overlaps.append(merge_list["overlaps"])
+    if len(overlaps) > 0 and sum([len(values) for values in overlaps]) > 0:
+        overlaps = numpy.concatenate(overlaps)
+        summary["min-merge-overlap"] = int(overlaps.min())
+        summary["median-merge-overlap"] = float(numpy.median(overlaps))
+    return summary
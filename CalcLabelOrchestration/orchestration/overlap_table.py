@@ -0,0 +1,89 @@
+import numpy
+
+"""
+Contingency table of label overlaps between two aligned label volumes.
+
+The table is built in one vectorized pass: each label volume is reduced to
+dense indices, the (label1, label2) pair is packed into a single integer
+key, and the keys are counted with a unique/bincount reduction.  Voxels
+where either label is 0 are ignored.
+
+Stitch jobs keep their table (and the bodies eligible for merging) so that
+the merges can be decided again with another stitching policy without
+reading the labels.
+"""
+
+class OverlapTable:
+    def __init__(self, body1, body2, counts):
+        self.body1 = body1
+        self.body2 = body2
+        self.counts = counts
+
+    # return table with body1 and body2 swapped
+    def transpose(self):
+        return OverlapTable(self.body2, self.body1, self.counts)
+
+    # for every body1, find the body2 with the largest overlap
+    # returns dict of body1 -> (best body2, max overlap, total overlap)
+    def best_overlaps(self):
+        best = {}
+        if len(self.counts) == 0:
+            return best
+
+        # sort by body1, then by decreasing count, then by body2 (ties go to the smaller id)
+        order = numpy.lexsort((self.body2, -self.counts.astype(numpy.int64), self.body1))
+        body1 = self.body1[order]
+        body2 = self.body2[order]
+        counts = self.counts[order]
+
+        bodies, first, inverse = numpy.unique(body1, return_index=True, return_inverse=True)
+        totals = numpy.bincount(inverse, weights=counts).astype(numpy.int64)
+
+        for body, idx, total in zip(bodies.tolist(), first.tolist(), totals.tolist()):
+            best[body] = (int(body2[idx]), int(counts[idx]), total)
+        return best
+
+
+# build overlap table for two label volumes of the same shape
+def compute_overlap_table(labels1, labels2):
+    if labels1.shape != labels2.shape:
+        raise Exception("label volumes have different shapes")
+
+    labels1 = labels1.ravel()
+    labels2 = labels2.ravel()
+
+    # ignore background in either volume
+    nonzero = (labels1 != 0) & (labels2 != 0)
+    labels1 = labels1[nonzero]
+    labels2 = labels2[nonzero]
+
+    if len(labels1) == 0:
+        empty = numpy.zeros(0, dtype=numpy.uint64)
+        return OverlapTable(empty, empty, numpy.zeros(0, dtype=numpy.int64))
+
+    # reduce to dense indices so that the pair key always fits in 64 bits
+    bodies1, index1 = numpy.unique(labels1, return_inverse=True)
+    bodies2, index2 = numpy.unique(labels2, return_inverse=True)
+
+    keys = index1.astype(numpy.int64) * len(bodies2) + index2
+    keys, counts = numpy.unique(keys, return_counts=True)
+
+    body1 = bodies1[keys // len(bodies2)].astype(numpy.uint64)
+    body2 = bodies2[keys % len(bodies2)].astype(numpy.uint64)
+
+    return OverlapTable(body1, body2, counts.astype(numpy.int64))
+
+# save a table and the sorted eligible bodies of both volumes
+def write_overlap_table(filename, table, eligible_bodies1, eligible_bodies2):
+    numpy.savez_compressed(filename, body1=table.body1, body2=table.body2, counts=table.counts,
+            eligible1=numpy.array(eligible_bodies1, dtype=numpy.uint64),
+            eligible2=numpy.array(eligible_bodies2, dtype=numpy.uint64))
+
+# returns the table and the eligible bodies of both volumes
+def read_overlap_table(filename):
+    data = numpy.load(filename)
+    table = OverlapTable(data["body1"], data["body2"], data["counts"])
+    eligible_bodies1 = data["eligible1"]
+    eligible_bodies2 = data["eligible2"]
+    data.close()
+    return table, eligible_bodies1, eligible_bodies2
@@ -0,0 +1,155 @@
+import h5py
+import numpy
+
+"""
+Cost-balanced partitioning of a volume into substacks.
+
+The cost of processing a region is estimated on a coarse grid of cells
+(z, y, x): from a DVID ROI (number of ROI blocks in each cell) or from a
+downsampled occupancy map (fraction of tissue in each cell).  The volume is
+split recursively along its longest axis at the position that divides the
+cost evenly until a region costs at most as much as a full job-size cube and
+no side is longer than the maximum job size.  Dense regions therefore get
+small substacks and mostly empty regions get large ones.  Cuts fall on cell
+boundaries and no substack side is shorter than the minimum size.
+"""
+
+# DVID ROI block size
+ROI_BLOCK_SIZE = 32
+
+# grid cells at most
+MAX_GRID_CELLS = 2**24
+
+# relative cost of empty voxels in an occupancy map (gray still has to be read and segmented)
+EMPTY_COST = 0.25
+
+class CostGrid:
+    # costs: (z, y, x) cost of each cell, origin: (x, y, z) voxel location of cell (0, 0, 0)
+    def __init__(self, costs, cell_size, origin):
+        self.costs = numpy.asarray(costs, dtype=numpy.float64)
+        self.cell_size = cell_size
+        self.origin = numpy.asarray(origin, dtype=numpy.int64)
+
+    # cell range [start, end) in (x, y, z) covering the voxel box [lower, upper)
+    def cell_range(self, lower, upper):
+        start = (numpy.asarray(lower) - self.origin) // self.cell_size
+        end = (numpy.asarray(upper) - self.origin - 1) // self.cell_size + 1
+        return start, end
+
+    # costs of the cells covering the voxel box as a (z, y, x) array (0 outside of the grid)
+    def region(self, lower, upper):
+        start, end = self.cell_range(lower, upper)
+        region = numpy.zeros((end - start)[::-1], dtype=numpy.float64)
+        inner_start = numpy.maximum(start, 0)
+        inner_end = numpy.maximum(numpy.minimum(end, self.costs.shape[::-1]), inner_start)
+        low = inner_start - start
+        high = inner_end - start
+        region[low[2]:high[2], low[1]:high[1], low[0]:high[0]] = self.costs[inner_start[2]:inner_end[2],
+                inner_start[1]:inner_end[1], inner_start[0]:inner_end[0]]
+        return region
+
+    def cost(self, lower, upper):
+        return self.region(lower, upper).sum()
+
+# cell size (multiple of the ROI block size) so that the grid has at most MAX_GRID_CELLS cells
+def grid_cell_size(lower, upper, job_size):
+    num_voxels = float(numpy.prod(numpy.asarray(upper, dtype=numpy.float64) - numpy.asarray(lower)))
+    cell_size = max(job_size / 4.0, (num_voxels / MAX_GRID_CELLS) ** (1.0/3))
+    return int(numpy.ceil(cell_size / ROI_BLOCK_SIZE)) * ROI_BLOCK_SIZE
+
+# same cost for every voxel in [lower, upper)
+def uniform_cost_grid(lower, upper, cell_size):
+    shape = (numpy.asarray(upper) - numpy.asarray(lower) - 1) // cell_size + 1
+    costs = numpy.zeros(shape[::-1], dtype=numpy.float64) + cell_size**3
+    return CostGrid(costs, cell_size, lower)
+
+# occupied voxels of a DVID ROI given as block spans [z, y, x1, x2] (x2 inclusive)
+def roi_cost_grid(spans, job_size):
+    spans = numpy.asarray(spans, dtype=numpy.int64).reshape(-1, 4)
+    lower_block = numpy.array([spans[:, 2].min(), spans[:, 1].min(), spans[:, 0].min()])
+    upper_block = numpy.array([spans[:, 3].max(), spans[:, 1].max(), spans[:, 0].max()]) + 1
+    cell_size = grid_cell_size(lower_block * ROI_BLOCK_SIZE, upper_block * ROI_BLOCK_SIZE, job_size)
+    blocks_per_cell = cell_size // ROI_BLOCK_SIZE
+    shape = (upper_block - lower_block - 1) // blocks_per_cell + 1
+
+    zcell = (spans[:, 0] - lower_block[2]) // blocks_per_cell
+    ycell = (spans[:, 1] - lower_block[1]) // blocks_per_cell
+    x1 = spans[:, 2] - lower_block[0]
+    x2 = spans[:, 3] - lower_block[0] + 1
+
+    # add the part of each span in each of the cells it crosses
+    counts = numpy.zeros(shape[::-1], dtype=numpy.float64).ravel()
+    xcell = x1 // blocks_per_cell
+    while True:
+        start = numpy.maximum(x1, xcell * blocks_per_cell)
+        end = numpy.minimum(x2, (xcell + 1) * blocks_per_cell)
+        active = end > start
+        if not numpy.any(active):
+            break
+        index = (zcell[active] * shape[1] + ycell[active]) * shape[0] + xcell[active]
+        counts += numpy.bincount(index, weights=(end - start)[active], minlength=len(counts))
+        xcell += 1
+
+    costs = counts.reshape(shape[::-1]) * ROI_BLOCK_SIZE**3
+    return CostGrid(costs, cell_size, lower_block * ROI_BLOCK_SIZE)
+
+# downsampled occupancy map ("occupancy" dataset (z, y, x) of fractions in [0, 1], "cell-size" attribute)
+def occupancy_cost_grid(filename):
+    hfile = h5py.File(filename, 'r')
+    occupancy = numpy.clip(hfile["occupancy"][:].astype(numpy.float64), 0, 1)
+    cell_size = int(hfile["occupancy"].attrs["cell-size"])
+    hfile.close()
+    costs = (EMPTY_COST + (1 - EMPTY_COST) * occupancy) * cell_size**3
+    return CostGrid(costs, cell_size, (0, 0, 0))
+
+# split [lower, upper) into (lower, upper, cost) regions; regions without cost are dropped if drop_empty
+def balanced_partition(grid, lower, upper, target_cost, min_size, max_size, drop_empty=False):
+    regions = []
+    pending = [(numpy.asarray(lower, dtype=numpy.int64), numpy.asarray(upper, dtype=numpy.int64))]
+    while len(pending) > 0:
+        lower, upper = pending.pop()
+        cost = grid.cost(lower, upper)
+        if cost == 0 and drop_empty:
+            continue
+
+        spans = upper - lower
+        if cost <= target_cost and numpy.all(spans <= max_size):
+            regions.append((lower, upper, cost))
+            continue
+
+        cut = find_cut(grid, lower, upper, min_size, cost <= target_cost)
+        if cut is None:
+            regions.append((lower, upper, cost))
+            continue
+        axis, location = cut
+        upper1 = upper.copy()
+        upper1[axis] = location
+        lower2 = lower.copy()
+        lower2[axis] = location
+        pending.append((lower2, upper))
+        pending.append((lower, upper1))
+    return regions
+
+# (axis, location) of the cell boundary that splits the longest axis possible, None if no side can be split
+# the cut divides the cost evenly, or the length if only the size is too large
+def find_cut(grid, lower, upper, min_size, by_size):
+    for axis in numpy.argsort(-(upper - lower), kind="mergesort"):
+        start = grid.origin[axis] + grid.cell_range(lower, upper)[0][axis] * grid.cell_size
+        boundaries = numpy.arange(start + grid.cell_size, upper[axis], grid.cell_size)
+        boundaries = boundaries[(boundaries - lower[axis] >= min_size) & (upper[axis] - boundaries >= min_size)]
+        if len(boundaries) == 0:
+            continue
+
+        if by_size:
+            middle = (lower[axis] + upper[axis]) / 2.0
+            return axis, int(boundaries[numpy.argmin(numpy.abs(boundaries - middle))])
+
+        # cost on the low side of each boundary
+        other = tuple([2 - other_axis for other_axis in range(3) if other_axis != axis])
+        profile = grid.region(lower, upper).sum(axis=other)
+        first_cell = grid.cell_range(lower, upper)[0][axis]
+        cumulative = numpy.cumsum(profile)
+        cells = (boundaries - grid.origin[axis]) // grid.cell_size - first_cell
+        low_cost = cumulative[cells - 1]
+        return axis, int(boundaries[numpy.argmin(numpy.abs(low_cost - cumulative[-1] / 2.0))])
+    return None
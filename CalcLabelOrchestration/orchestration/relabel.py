@@ -0,0 +1,72 @@
+import numpy
+from orchestration.label_io import narrow_dtype
+
+"""
+Vectorized relabeling of label volumes.
+
+A substack's labels are shifted by its global id offset (0 stays 0) and then
+mapped through the merge list, in a single gather over the volume.  When
+the local label range is compact a dense lookup table indexed by label is
+used; otherwise the distinct labels are mapped with a sorted-key search.
+
+Consolidated mappings are stored per substack as a remap shard: a .npy file
+with the sorted keys (row 0) and values (row 1) of the mappings of the
+substack's global id range, which remap jobs memory map.
+"""
+
+remapShardName = "remap.npy"
+
+# use a dense lookup table if it has at most this many entries per voxel
+DENSE_LUT_RATIO = 4
+
+# create sorted key/value arrays from a list of [old, new] mappings
+def mapping_arrays(remap):
+    remap = numpy.array(remap, dtype=numpy.uint64).reshape(-1, 2)
+    order = numpy.argsort(remap[:, 0], kind="mergesort")
+    return remap[order, 0], remap[order, 1]
+
+# write sorted key/value arrays as a remap shard
+def write_mapping_shard(filename, keys, values):
+    numpy.save(filename, numpy.vstack((keys, values)).astype(numpy.uint64).reshape(2, -1))
+
+# memory mapped key/value arrays of a remap shard
+def read_mapping_shard(filename):
+    shard = numpy.load(filename, mmap_mode='r')
+    return shard[0], shard[1]
+
+# apply sorted mapping to an array of labels (labels not in keys are unchanged)
+def apply_mapping(labels, keys, values):
+    if len(keys) == 0:
+        return labels
+    pos = numpy.searchsorted(keys, labels)
+    pos[pos == len(keys)] = 0
+    found = keys[pos] == labels
+    return numpy.where(found, values[pos], labels)
+
+# shift labels by offset and apply mapping, returns labels of the narrowest type that holds them
+def relabel(labels, offset=0, keys=None, values=None):
+    if keys is None:
+        keys = values = numpy.zeros(0, dtype=numpy.uint64)
+
+    offset = numpy.uint64(offset)
+    if labels.size == 0:
+        return numpy.zeros(labels.shape, dtype=narrow_dtype(0))
+    max_label = int(labels.max())
+
+    if max_label + 1 <= DENSE_LUT_RATIO * labels.size:
+        # lookup table over every possible local label
+        lut = numpy.arange(max_label + 1, dtype=numpy.uint64) + offset
+        lut[0] = 0
+        lut = apply_mapping(lut, keys, values)
+        lut[0] = 0
+        lut = lut.astype(narrow_dtype(int(lut.max())))
+        return lut[labels]
+
+    # sparse labels -- map only the labels that are present
+    bodies, inverse = numpy.unique(labels, return_inverse=True)
+    mapped = bodies.astype(numpy.uint64) + offset
+    mapped[bodies == 0] = 0
+    mapped = apply_mapping(mapped, keys, values)
+    mapped[bodies == 0] = 0
+    mapped = mapped.astype(narrow_dtype(int(mapped.max())))
+    return mapped[inverse].reshape(labels.shape)
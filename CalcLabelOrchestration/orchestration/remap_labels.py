@@ -5,6 +5,94 @@ import struct
 import json
 import requests
 import time
+from orchestration.relabel import relabel, mapping_arrays, read_mapping_shard
+from orchestration.body_assignment import write_body_sizes
+from orchestration.label_io import read_labels, create_labels, label_shape, DEFAULT_FORMAT
+
+# working memory per voxel of a slab (stored labels, uint64 labels and lookups)
+BYTES_PER_VOXEL = 32
+
+# number of z planes per slab that fit the memory budget (multiple of the chunk size if possible)
+def slab_depth(shape, budget_bytes, chunk_size):
+    plane_bytes = max(shape[1] * shape[2] * BYTES_PER_VOXEL, 1)
+    depth = max(int(budget_bytes // plane_bytes), 1)
+    if depth >= chunk_size:
+        depth -= depth % chunk_size
+    return depth
+
+# [start, end) slabs of at most depth planes; if depth allows, slabs start at multiples of align relative to -origin
+def slab_bounds(length, depth, origin=0, align=1):
+    if depth >= align:
+        first = (-origin) % align
+        starts = [start for start in range(first, length, depth) if start > 0]
+    else:
+        starts = range(depth, length, depth)
+    bounds = [0] + starts + [length]
+    return [(bounds[index], bounds[index+1]) for index in range(len(bounds) - 1) if bounds[index+1] > bounds[index]]
+
+# combine label counts (ids sorted)
+def add_counts(ids, counts, ids2, counts2):
+    ids, inverse = numpy.unique(numpy.concatenate((ids, ids2)), return_inverse=True)
+    counts = numpy.bincount(inverse, weights=numpy.concatenate((counts, counts2)), minlength=len(ids))
+    return ids, counts.astype(numpy.uint64)
+
+# offsets and remaps the core of a substack one z slab at a time
+class SlabRemapper:
+    # origin and align: slabs start at multiples of align in the coordinates of origin + local z
+    def __init__(self, json_data, origin=0, align=None):
+        self.json_data = json_data
+        if "remap-shard" in json_data:
+            self.keys, self.values = read_mapping_shard(json_data["remap-shard"])
+        else:
+            # global mappings (remap.json of older sessions)
+            json_data2 = json.load(open(json_data["remapjson"]))
+            self.keys, self.values = mapping_arrays(json_data2["remap"])
+        self.offset = json_data["offset"]
+
+        # crop labels
+        self.bufsz = json_data["border"]
+        z, y, x = label_shape(json_data["labels"])
+        self.shape = (z - 2*self.bufsz, y - 2*self.bufsz, x - 2*self.bufsz)
+
+        # the core is processed in z slabs so memory does not depend on the substack size
+        self.label_format = json_data.get("label-format")
+        if self.label_format is None:
+            self.label_format = {}
+        chunk_size = self.label_format.get("chunk-size", DEFAULT_FORMAT["chunk-size"])
+        if align is None:
+            align = chunk_size
+        depth = slab_depth(self.shape, json_data.get("slab-memory-mb", 512) * 2**20, align)
+        self.slabs = slab_bounds(self.shape[0], depth, origin, align)
+
+        # labels in the core and their voxel counts
+        self.ids = numpy.zeros(0, dtype=numpy.uint64)
+        self.counts = numpy.zeros(0, dtype=numpy.uint64)
+        for start, end in self.slabs:
+            slab_ids, slab_counts = numpy.unique(self.read_slab(start, end), return_counts=True)
+            self.ids, self.counts = add_counts(self.ids, self.counts, slab_ids.astype(numpy.uint64), slab_counts.astype(numpy.uint64))
+
+        # offset and remap in one pass (remapping is based off of the offset labels)
+        self.mapped = relabel(self.ids, self.offset, self.keys, self.values)
+        self.max_label = 0
+        if self.mapped.size > 0:
+            self.max_label = int(self.mapped.max())
+
+    def read_slab(self, start, end):
+        bufsz = self.bufsz
+        return read_labels(self.json_data["labels"], (slice(bufsz + start, bufsz + end),
+            slice(bufsz, bufsz + self.shape[1]), slice(bufsz, bufsz + self.shape[2])))
+
+    # (start, end, remapped labels) of each slab
+    def remapped_slabs(self):
+        for start, end in self.slabs:
+            yield start, end, relabel(self.read_slab(start, end), self.offset, self.keys, self.values)
+
+    # body sizes in the substack core (used to assign bodies to substacks)
+    def write_body_sizes(self, filename):
+        bodies, inverse = numpy.unique(self.mapped, return_inverse=True)
+        sizes = numpy.bincount(inverse, weights=self.counts, minlength=len(bodies)).astype(numpy.uint64)
+        keep = bodies != 0
+        write_body_sizes(filename, bodies[keep].astype(numpy.uint64), sizes[keep])
 
 def execute(argv):
     parser = argparse.ArgumentParser(description="Remaps h5")
@@ -12,36 +100,11 @@ def execute(argv):
     args = parser.parse_args()
 
     json_data = json.load(open(args.config_file))
-    json_data2 = json.load(open(json_data["remapjson"]))
-
-    hfile = h5py.File(json_data["labels"], 'r')
-    labels = numpy.array(hfile['stack']).astype(numpy.uint64)
-
-    # crop labels
-    bufsz = json_data["border"]
-    labels = labels[bufsz:-1*bufsz, bufsz:-1*bufsz, bufsz:-1*bufsz]
-
-    roi = json_data["roi"]
-
-    # remapping is based off of an adjusted set of labels (if necessary)
-    if json_data["offset"] != 0:
-        labels = labels + json_data["offset"]
-        # make sure 0 is 0
-        labels[labels == json_data["offset"]] = 0
-
-    # json mapping should exist
-    if len(json_data2["remap"]) != 0:
-        mapping_col = numpy.unique(labels)
-        label_mappings = dict(zip(mapping_col, mapping_col))
-        
-        remap_data = json_data2["remap"]
-        for mapping in remap_data:
-            label_mappings[mapping[0]] = mapping[1]
-
-        vectorized_relabel = numpy.frompyfunc(label_mappings.__getitem__, 1, 1)
-        labels = vectorized_relabel(labels).astype(numpy.uint32)
-   
-    fout = h5py.File(json_data["labelsout"], 'a')
-    fout.create_dataset("stack", data=labels)
+    remapper = SlabRemapper(json_data)
+
+    fout, dset = create_labels(json_data["labelsout"], remapper.shape, remapper.max_label, remapper.label_format)
+    for start, end, labels in remapper.remapped_slabs():
+        dset[start:end] = labels
     fout.close()
 
+    remapper.write_body_sizes(json_data["bodiesout"])
@@ -0,0 +1,54 @@
+import argparse
+import glob
+import json
+from orchestration.stitch_labels import redecide
+from orchestration.merge_lists import read_merge_list, summarize_merge_lists, stitchSummaryName
+
+"""
+Re-decide the stitching of a session with another policy.
+
+Every stitch job keeps its overlap table (overlap_N.npz), so the merge lists
+of a session can be decided again with another stitching mode or thresholds
+in seconds, without cluster jobs or reading the label volumes.  The stitch
+configurations and merge lists of the session are rewritten and the totals
+are printed and written to stitch_summary.json.  To write the new labels,
+set the same policy in the session config.json and resume the session
+(calclabels_cluster --resume); the consolidation also re-decides any merge
+list that was stitched with another policy.
+"""
+
+def execute(argv):
+    parser = argparse.ArgumentParser(description="Decides stitching merges again from cached overlaps")
+    parser.add_argument('session_location', type=str, help="Session directory")
+    parser.add_argument('--stitch-mode', type=int, default=None, help="0 (off), 1 (conservative), 2 (less conservative) or 3 (liberal)")
+    parser.add_argument('--hard-lb', type=int, default=None, help="Minimum overlap of a merge")
+    parser.add_argument('--liberal-lb', type=int, default=None, help="Minimum overlap of a one-sided merge (mode 3)")
+    parser.add_argument('--conservative-overlap', type=float, default=None, help="Overlap fraction for modes 1 and 3")
+    args = parser.parse_args()
+
+    thresholds = {}
+    for name, value in (("hard-lb", args.hard_lb), ("liberal-lb", args.liberal_lb), ("conservative-overlap", args.conservative_overlap)):
+        if value is not None:
+            thresholds[name] = value
+
+    merge_lists = []
+    for config_file in sorted(glob.glob(args.session_location + "/*/config_stitch*.json")):
+        json_data = json.load(open(config_file))
+        if "overlaps" not in json_data:
+            raise Exception("No cached overlaps for " + config_file)
+        if args.stitch_mode is not None:
+            json_data["stitching-mode"] = args.stitch_mode
+        json_data.setdefault("stitch-thresholds", {}).update(thresholds)
+
+        fout = open(config_file, 'w')
+        fout.write(json.dumps(json_data, indent=4))
+        fout.close()
+
+        redecide(json_data)
+        merge_lists.append(read_merge_list(json_data["merges"]))
+
+    summary = summarize_merge_lists(merge_lists)
+    fout = open(args.session_location + "/" + stitchSummaryName, 'w')
+    fout.write(json.dumps(summary, indent=4, sort_keys=True))
+    fout.close()
+    print json.dumps(summary, indent=4, sort_keys=True)
@@ -0,0 +1,261 @@
+import time
+from collections import OrderedDict, deque
+from orchestration.manifest import outputs_valid
+
+"""
+Dependency-driven job scheduler.
+
+Jobs are added with the jobs they depend on (e.g., a stitch job depends on
+the agglomeration of both substacks).  A job is ready as soon as all of its
+dependencies have finished, so a slow substack only holds up the jobs
+that actually need its output.
+
+Per-stage and per-resource (DVID) limits cap the number of submitted but
+unfinished jobs.  Ready jobs are submitted as one job array per stage once
+min_refill of them (at most a tenth of the limit) can go, or refill_delay
+seconds after the first of them could, so a stage at its limit is refilled
+in batches instead of with one job array per finished job.
+
+A failed job does not stop independent work; its dependents are never run
+and the failure is raised once nothing else can run.
+
+Successful jobs are recorded in the session manifest.  When resuming, a
+job that is complete with valid outputs is not run again unless one of its
+dependencies is rerun.
+
+Submit/finish times and resource usage of every job are passed to the
+session's JobMetrics (see telemetry).
+"""
+
+# job in the dependency graph
+class Job:
+    def __init__(self, stage, task, dependencies):
+        self.stage = stage
+        self.task = task
+        self.dependencies = dependencies
+        self.dependents = []
+        self.num_waiting = 0
+        self.job_id = None
+        self.state = "waiting"
+        # completed in a previous run
+        self.skipped = False
+
+class DagScheduler:
+    # stage_limits: maximum number of submitted but unfinished jobs for a stage
+    # resource_limits: maximum number of submitted but unfinished jobs using a resource ("dvid")
+    # min_refill, refill_delay: free places and seconds to wait for before refilling a window
+    def __init__(self, executor, session_location, message, stage_limits=None, resource_limits=None, poll_time=10, manifest=None, resume=False, metrics=None, min_refill=100, refill_delay=30):
+        self.executor = executor
+        self.session_location = session_location
+        self.message = message
+        self.stage_limits = stage_limits
+        if self.stage_limits is None:
+            self.stage_limits = {}
+        self.resource_limits = resource_limits
+        if self.resource_limits is None:
+            self.resource_limits = {}
+        self.poll_time = poll_time
+        self.manifest = manifest
+        self.resume = resume
+        self.metrics = metrics
+        self.min_refill = min_refill
+        self.refill_delay = refill_delay
+
+        self.jobs = []
+        # stage -> ready jobs in the order they became ready
+        self.ready = OrderedDict()
+        self.num_ready = 0
+        # limit key -> number of submitted but unfinished jobs
+        self.in_flight = {}
+        # stage -> time since when it has free places that were not refilled
+        self.refill_since = {}
+        self.running = {}
+        self.failed = []
+        self.num_arrays = 0
+        self.last_report = 0
+
+    # add job that runs after all dependencies finish, returns the job
+    def add(self, stage, task, dependencies=[]):
+        job = Job(stage, task, dependencies)
+        if self.can_skip(job):
+            job.state = "done"
+            job.skipped = True
+        for dependency in dependencies:
+            dependency.dependents.append(job)
+            if dependency.state != "done":
+                job.num_waiting += 1
+
+        self.jobs.append(job)
+        if job.num_waiting == 0 and job.state == "waiting":
+            self.push_ready(job)
+        return job
+
+    def push_ready(self, job):
+        job.state = "ready"
+        if job.stage not in self.ready:
+            self.ready[job.stage] = deque()
+        self.ready[job.stage].append(job)
+        self.num_ready += 1
+
+    # job finished in a previous run and nothing it depends on is rerun
+    def can_skip(self, job):
+        if not self.resume or self.manifest is None:
+            return False
+        if not self.manifest.is_complete(job.task.name):
+            return False
+        for dependency in job.dependencies:
+            if not dependency.skipped:
+                return False
+        return outputs_valid(job.task.outputs)
+
+    # stage and resource classes whose in-flight limits apply to a job
+    def limit_keys(self, job):
+        keys = [("stage", job.stage)]
+        if job.task.dvid:
+            keys.append(("resource", "dvid"))
+        return keys
+
+    def limit(self, key):
+        if key[0] == "stage":
+            return self.stage_limits.get(key[1])
+        return self.resource_limits.get(key[1])
+
+    # number of jobs like job that can be submitted before a limit is reached (None if unlimited)
+    def free_places(self, job):
+        free = None
+        for key in self.limit_keys(job):
+            limit = self.limit(key)
+            if limit is not None:
+                places = limit - self.in_flight.get(key, 0)
+                if free is None or places < free:
+                    free = places
+        return free
+
+    # free places worth a job array for jobs like job
+    def refill_size(self, job):
+        size = self.min_refill
+        for key in self.limit_keys(job):
+            limit = self.limit(key)
+            if limit is not None:
+                size = min(size, max(1, limit // 10))
+        return size
+
+    # submit ready jobs while under the in-flight limits, one job array for each stage and resource type
+    def submit_ready(self):
+        now = time.time()
+        groups = {}
+        group_order = []
+        for stage, queue in self.ready.items():
+            if len(queue) == 0:
+                continue
+            free = self.free_places(queue[0])
+            if free is not None and free <= 0:
+                continue
+            # wait for a batch while running jobs can still add to it
+            batch = len(queue)
+            if free is not None:
+                batch = min(batch, free)
+            if batch < self.refill_size(queue[0]) and len(self.running) > 0:
+                since = self.refill_since.setdefault(stage, now)
+                if now - since < self.refill_delay:
+                    continue
+            self.refill_since.pop(stage, None)
+
+            while len(queue) > 0:
+                job = queue[0]
+                free = self.free_places(job)
+                if free is not None and free <= 0:
+                    break
+                queue.popleft()
+                self.num_ready -= 1
+                for key in self.limit_keys(job):
+                    self.in_flight[key] = self.in_flight.get(key, 0) + 1
+
+                key = (job.stage, job.task.slots, job.task.dvid)
+                if key not in groups:
+                    groups[key] = []
+                    group_order.append(key)
+                groups[key].append(job)
+
+        for key in group_order:
+            jobs = groups[key]
+            tasks_file = self.session_location + "/" + key[0] + "_tasks_" + str(self.num_arrays) + ".json"
+            self.num_arrays += 1
+
+            job_ids = self.executor.submit([job.task for job in jobs], tasks_file)
+            for job, job_id in zip(jobs, job_ids):
+                job.job_id = job_id
+                job.state = "running"
+                self.running[job_id] = job
+                if self.metrics is not None:
+                    self.metrics.submit(job_id, job.stage, job.task.name)
+
+    # record finished job and release its dependents
+    def finish(self, result):
+        job = self.running.pop(result.job_id)
+        for key in self.limit_keys(job):
+            self.in_flight[key] -= 1
+        if self.metrics is not None:
+            self.metrics.finish(result)
+        if not result.success:
+            job.state = "failed"
+            self.failed.append(job)
+            return
+
+        job.state = "done"
+        if self.manifest is not None:
+            self.manifest.mark_complete(job.task.name)
+        for dependent in job.dependents:
+            dependent.num_waiting -= 1
+            if dependent.num_waiting == 0 and dependent.state == "waiting":
+                self.push_ready(dependent)
+
+    # write number of jobs in each state for each stage
+    def report(self, force=False):
+        if not force and time.time() - self.last_report < self.poll_time:
+            return
+        self.last_report = time.time()
+
+        stages = []
+        counts = {}
+        for job in self.jobs:
+            if job.stage not in counts:
+                stages.append(job.stage)
+                counts[job.stage] = {}
+            counts[job.stage][job.state] = counts[job.stage].get(job.state, 0) + 1
+
+        current_message = ""
+        for stage in stages:
+            current_message += "<b>" + stage + "</b>: "
+            current_message += ", ".join([state + " " + str(counts[stage].get(state, 0)) for state in ("waiting", "ready", "running", "done", "failed")])
+            num_skipped = len([job for job in self.jobs if job.stage == stage and job.skipped])
+            if num_skipped > 0:
+                current_message += " (" + str(num_skipped) + " done in previous run)"
+            current_message += "<br>"
+        self.message.write_status(current_message)
+
+    # run until every job finished or cannot run because of a failure
+    def run(self):
+        while self.num_ready > 0 or len(self.running) > 0:
+            self.submit_ready()
+
+            result = self.executor.wait_any(self.poll_time)
+            if result is None:
+                self.report()
+                continue
+            self.finish(result)
+
+            # collect everything else that has finished before submitting more work
+            while len(self.running) > 0:
+                result = self.executor.wait_any(0)
+                if result is None:
+                    break
+                self.finish(result)
+            self.report()
+
+        self.report(True)
+        if self.metrics is not None:
+            self.metrics.summary()
+        if len(self.failed) > 0:
+            not_run = len([job for job in self.jobs if job.state == "waiting"])
+            raise Exception("JOB failure in " + ", ".join([job.task.name + " (job " + str(job.job_id) + ")" for job in self.failed]) + "; " + str(not_run) + " dependent jobs not run")
@@ -0,0 +1,72 @@
+"""
+Hash-grid index over substack extents for finding stitch pairs.
+
+Every substack registers its low face along each axis, keyed by the face
+coordinate and the grid cells its extent covers in the other two axes.  A
+substack's neighbors across its high face are then found by looking up the
+same cells at its high face coordinate, which takes near-linear time instead
+of testing all pairs.  Candidates are confirmed with Substack.isoverlap so
+that the pairs are exactly those of the all-pairs test.
+"""
+
+AXES = ("x", "y", "z")
+
+# [start, end) of a substack roi along an axis
+def extent(roi, axis):
+    if axis == "x":
+        return roi.x1, roi.x2
+    if axis == "y":
+        return roi.y1, roi.y2
+    return roi.z1, roi.z2
+
+# median extent along each axis is used as the grid cell size
+def cell_sizes(substacks):
+    sizes = {}
+    for axis in AXES:
+        spans = sorted([extent(substack.roi, axis)[1] - extent(substack.roi, axis)[0] for substack in substacks])
+        sizes[axis] = max(spans[len(spans)//2], 1)
+    return sizes
+
+# grid cells covered by the roi in the two axes other than face_axis
+def face_cells(roi, face_axis, sizes):
+    axis1, axis2 = [axis for axis in AXES if axis != face_axis]
+    start1, end1 = extent(roi, axis1)
+    start2, end2 = extent(roi, axis2)
+    if end1 <= start1 or end2 <= start2:
+        return []
+
+    cells = []
+    for cell1 in range(start1 // sizes[axis1], (end1 - 1) // sizes[axis1] + 1):
+        for cell2 in range(start2 // sizes[axis2], (end2 - 1) // sizes[axis2] + 1):
+            cells.append((cell1, cell2))
+    return cells
+
+# return sorted (i, j) index pairs, i < j, of substacks that need to be stitched
+def find_stitch_pairs(substacks):
+    if len(substacks) == 0:
+        return []
+    sizes = cell_sizes(substacks)
+
+    # (axis, low face coordinate, cell) -> substack indices
+    low_faces = {}
+    for index, substack in enumerate(substacks):
+        for axis in AXES:
+            face = extent(substack.roi, axis)[0]
+            for cell in face_cells(substack.roi, axis, sizes):
+                low_faces.setdefault((axis, face, cell), []).append(index)
+
+    # neighbors whose low face is this substack's high face
+    candidates = set()
+    for index, substack in enumerate(substacks):
+        for axis in AXES:
+            face = extent(substack.roi, axis)[1]
+            for cell in face_cells(substack.roi, axis, sizes):
+                for index2 in low_faces.get((axis, face, cell), []):
+                    if index2 != index:
+                        candidates.add((min(index, index2), max(index, index2)))
+
+    pairs = []
+    for index1, index2 in sorted(candidates):
+        if substacks[index1].isoverlap(substacks[index2]):
+            pairs.append((index1, index2))
+    return pairs
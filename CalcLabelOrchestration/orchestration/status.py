@@ -0,0 +1,83 @@
+import threading
+import time
+import Queue
+import requests
+
+"""
+Background publisher for status messages.
+
+Status updates are posted to the result callback by a separate thread so a
+slow or unreachable callback never blocks the orchestration.  The callback
+stores the last document it receives (a DVID key-value), so each update is a
+complete document: updates queued while a post is in flight are coalesced
+into the newest one, an update identical to the last one sent is dropped
+and posts are at least min_interval seconds apart.  The queue is bounded;
+when it is full the oldest update is discarded.  close() sends the last
+update before returning.
+"""
+
+class StatusPublisher:
+    def __init__(self, url, min_interval=5, timeout=30, max_pending=100):
+        self.url = url
+        self.min_interval = min_interval
+        self.timeout = timeout
+        self.queue = Queue.Queue(max_pending)
+        self.closing = threading.Event()
+        self.last_sent = None
+
+        self.thread = threading.Thread(target=self.publish)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # queue update without blocking (None stops the publisher)
+    def put(self, data):
+        while True:
+            try:
+                self.queue.put_nowait(data)
+                return
+            except Queue.Full:
+                try:
+                    self.queue.get_nowait()
+                except Queue.Empty:
+                    pass
+
+    def post(self, data):
+        try:
+            requests.post(self.url, data=data, headers={'content-type': 'text/html'}, timeout=self.timeout)
+            self.last_sent = data
+        except Exception, e:
+            print "Status update failed: " + str(e)
+
+    def publish(self):
+        stop = False
+        while not stop:
+            data = self.queue.get()
+
+            # only the newest queued update is sent
+            while True:
+                if data is None:
+                    stop = True
+                    break
+                try:
+                    newer = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if newer is None:
+                    stop = True
+                    break
+                data = newer
+
+            if data is not None and data != self.last_sent:
+                sent_time = time.time()
+                self.post(data)
+                # rate limit, but do not delay the final update
+                if not stop:
+                    self.closing.wait(max(self.min_interval - (time.time() - sent_time), 0))
+
+    # send the last update and stop (waits at most timeout seconds)
+    def close(self, timeout=None):
+        self.closing.set()
+        self.put(None)
+        if timeout is None:
+            timeout = self.timeout
+        self.thread.join(timeout)
@@ -4,6 +4,12 @@ import numpy
 import struct
 import json
 import requests
+from orchestration.overlap_table import compute_overlap_table, write_overlap_table, read_overlap_table
+from orchestration.label_io import read_labels
+from orchestration.merge_lists import write_merge_list
+
+# minimum overlap of a merge, minimum overlap of a one-sided (mode 3) merge and overlap fraction for modes 1 and 3
+DEFAULT_THRESHOLDS = {"hard-lb": 50, "liberal-lb": 1000, "conservative-overlap": 0.90}
 
 # compute overlap -- assume first point is less than second
 def intersects(pt1, pt2, pt1_2, pt2_2):
@@ -20,6 +26,119 @@ def intersects(pt1, pt2, pt1_2, pt2_2):
 
     return npt1, npt1+size, npt1_2, npt1_2+size
 
+# stitching mode and thresholds of a stitch configuration
+def stitch_policy(json_data):
+    # 0 is off, 1 is very conservative (high percentages and no bridging), 2 is less conservative (no bridging), 3 is the most liberal (some bridging allowed if overlap greater than X and overlap threshold)
+    mode = json_data["stitching-mode"]
+    thresholds = dict(DEFAULT_THRESHOLDS)
+    thresholds.update(json_data.get("stitch-thresholds", {}))
+    return mode, thresholds["hard-lb"], thresholds["liberal-lb"], thresholds["conservative-overlap"]
+
+# decide the merges of a stitch job again from its cached overlap table (policy from json_data)
+def redecide(json_data):
+    table, eligible_bodies1, eligible_bodies2 = read_overlap_table(json_data["overlaps"])
+    write_merges(json_data, *decide_merges(table, eligible_bodies1.tolist(), eligible_bodies2.tolist(), *stitch_policy(json_data)))
+
+# returns merge list, overlap of each merge, total overlaps of both bodies and candidate counts
+def decide_merges(table, eligible_bodies1, eligible_bodies2, mode, hard_lb, liberal_lb, conservative_overlap):
+    # body2 -> (body1, max overlap, total overlap) and body1 -> (body2, max overlap, total overlap)
+    body2body1 = {}
+    body1body2 = {}
+
+    if mode > 0:
+        body1body2 = table.best_overlaps()
+        body2body1 = table.transpose().best_overlaps()
+    else:
+        eligible_bodies2 = set()
+        eligible_bodies1 = set()
+
+    # create merge list (with the overlap of each merged pair)
+    merge_list = []
+    merge_overlaps = []
+    mutual_list = {}
+    retired_list = set()
+
+    small_overlap_prune = 0
+    conservative_prune = 0
+    aggressive_add = 0
+    not_mutual = 0
+
+    for body2 in eligible_bodies2:
+        body2 = int(body2)
+        bodysave, max_val, total_val = body2body1.get(body2, (-1, 0, 0))
+        if max_val <= hard_lb:
+            small_overlap_prune += 1
+        elif (mode == 1) and (max_val / float(total_val) < conservative_overlap):
+            conservative_prune += 1
+        elif (mode == 3) and (max_val / float(total_val) > conservative_overlap) and (max_val > liberal_lb):
+            merge_list.append([bodysave, body2])
+            merge_overlaps.append(max_val)
+            # do not add
+            retired_list.add((bodysave, body2)) 
+            aggressive_add += 1
+        else:
+            if bodysave not in mutual_list:
+                mutual_list[bodysave] = {}
+            mutual_list[bodysave][body2] = max_val
+   
+    # add to merge list 
+    for body1 in eligible_bodies1:
+        body1 = int(body1)
+        bodysave, max_val, total_val = body1body2.get(body1, (-1, 0, 0))
+        if max_val <= hard_lb:
+            bodysave = -1
+
+        if (body1, bodysave) in retired_list:
+            # already in list
+            pass
+        elif bodysave == -1:
+            small_overlap_prune += 1
+        elif (mode == 1) and (max_val / float(total_val) < conservative_overlap):
+            conservative_prune += 1
+        elif (mode == 3) and (max_val / float(total_val) > conservative_overlap) and (max_val > liberal_lb):
+            merge_list.append([body1, bodysave])
+            merge_overlaps.append(max_val)
+            aggressive_add += 1
+        elif body1 in mutual_list:
+            partners = mutual_list[body1]
+            if bodysave in partners:
+                merge_list.append([body1, bodysave])
+                merge_overlaps.append(max_val)
+            else:
+                not_mutual += 1
+        else:
+            not_mutual += 1
+                    
+    totals1 = [body1body2.get(body1, (-1, 0, 0))[2] for body1, body2 in merge_list]
+    totals2 = [body2body1.get(body2, (-1, 0, 0))[2] for body1, body2 in merge_list]
+    stats = {"small-overlap-prune": small_overlap_prune, "conservative-prune": conservative_prune,
+            "aggressive-add": aggressive_add, "not-mutual": not_mutual}
+    return merge_list, merge_overlaps, totals1, totals2, stats
+
+# write the merge list json (and binary merge list if configured)
+def write_merges(json_data, merge_list, merge_overlaps, totals1, totals2, stats):
+    # print stats
+    print "Small overlap prune: ", stats["small-overlap-prune"]
+    print "Conservative (mode 1) overlap percentage prune: ", stats["conservative-prune"]
+    print "Aggressive adding (mode 3) using overlap percentage for only one side: ", stats["aggressive-add"]
+    print "No candidates merge found because not mutual: ", stats["not-mutual"]
+    print "Num mergers: ", len(merge_list)
+
+    # output json
+    outjson = {}
+    outjson["id"] = json_data["id"]
+    outjson["merge_list"] = merge_list
+  
+    fout = open(json_data["output"], 'w')
+    jstr = json.dumps(outjson, indent=4)
+    fout.write(jstr)
+    fout.close()
+
+    # binary merge list and overlap statistics read by the consolidation
+    if "merges" in json_data:
+        write_merge_list(json_data["merges"], json_data["id"], merge_list, merge_overlaps, totals1, totals2, stats,
+                stitch_policy(json_data))
+
 def execute(argv):
     parser = argparse.ArgumentParser(description="Analyzed overlapping label volumes and writes merge list")
     parser.add_argument('config_file', type=str, help="Location of configuration json")
@@ -33,16 +152,13 @@ def execute(argv):
     bbx1_2, bby1_2, bbz1_2 = json_data["bbox1_2"]
     bbx2_2, bby2_2, bbz2_2 = json_data["bbox2_2"]
 
-    hfile = h5py.File(json_data["labels"], 'r')
-    hfile2 = h5py.File(json_data["labels_2"], 'r')
-
     # crop two volumes to overlap
     offx1, offx2, offx1_2, offx2_2 = intersects(bbx1, bbx2, bbx1_2, bbx2_2)
     offy1, offy2, offy1_2, offy2_2 = intersects(bby1, bby2, bby1_2, bby2_2)
     offz1, offz2, offz1_2, offz2_2 = intersects(bbz1, bbz2, bbz1_2, bbz2_2)
 
-    labels1 = numpy.array(hfile['stack'][offz1:offz2, offy1:offy2, offx1:offx2])
-    labels2= numpy.array(hfile2['stack'][offz1_2:offz2_2, offy1_2:offy2_2, offx1_2:offx2_2])
+    labels1 = read_labels(json_data["labels"], (slice(offz1, offz2), slice(offy1, offy2), slice(offx1, offx2)))
+    labels2 = read_labels(json_data["labels_2"], (slice(offz1_2, offz2_2), slice(offy1_2, offy2_2), slice(offx1_2, offx2_2)))
 
     # determine list of bodies in play
     z2, y2, x2 = labels2.shape
@@ -57,132 +173,19 @@ def execute(argv):
     if 'z' in json_data["overlap-axis"]:
         z1 = z2/2 
         z2 = z1 + 1
-    eligible_bodies = set(numpy.unique(labels2[z1:z2, y1:y2, x1:x2]))
-    body2body = {}
-
-    label2_bodies = numpy.unique(labels2)
-
-    # 0 is off, 1 is very conservative (high percentages and no bridging), 2 is less conservative (no bridging), 3 is the most liberal (some bridging allowed if overlap greater than X and overlap threshold)
-    mode = json_data["stitching-mode"]
-    hard_lb = 50
-    liberal_lb = 1000
-    conservative_overlap = 0.90
-
-    if mode > 0:
-        for body in label2_bodies:
-            if body == 0:
-                continue
-            body2body[body] = {}
-
-        # traverse volume to find maximum overlap
-        for (z,y,x), body1 in numpy.ndenumerate(labels1):
-            body2 = labels2[z,y,x]
-            if body2 == 0 or body1 == 0:
-                continue
-            if body1 not in body2body[body2]:
-                body2body[body2][body1] = 0
-            body2body[body2][body1] += 1
-
-
-    # create merge list 
-    merge_list = []
-    mutual_list = {}
-    retired_list = set()
-
-    small_overlap_prune = 0
-    conservative_prune = 0
-    aggressive_add = 0
-    not_mutual = 0
-
-    for body2, bodydict in body2body.items():
-        if body2 in eligible_bodies:
-            bodysave = -1
-            max_val = hard_lb
-            total_val = 0
-            for body1, val in bodydict.items():
-                total_val += val
-                if val > max_val:
-                    bodysave = body1
-                    max_val = val
-            if bodysave == -1:
-                small_overlap_prune += 1
-            elif (mode == 1) and (max_val / float(total_val) < conservative_overlap):
-                conservative_prune += 1
-            elif (mode == 3) and (max_val / float(total_val) > conservative_overlap) and (max_val > liberal_lb):
-                merge_list.append([int(bodysave), int(body2)])
-                # do not add
-                retired_list.add((int(bodysave), int(body2))) 
-                aggressive_add += 1
-            else:
-                if int(bodysave) not in mutual_list:
-                    mutual_list[int(bodysave)] = {}
-                mutual_list[int(bodysave)][int(body2)] = max_val
-               
-
-    eligible_bodies = set(numpy.unique(labels1[z1:z2, y1:y2, x1:x2]))
-    body2body = {}
-    
-    if mode > 0:
-        label1_bodies = numpy.unique(labels1)
-        for body in label1_bodies:
-            if body == 0:
-                continue
-            body2body[body] = {}
-
-        # traverse volume to find maximum overlap
-        for (z,y,x), body1 in numpy.ndenumerate(labels1):
-            body2 = labels2[z,y,x]
-            if body2 == 0 or body1 == 0:
-                continue
-            if body2 not in body2body[body1]:
-                body2body[body1][body2] = 0
-            body2body[body1][body2] += 1
-    
-    # add to merge list 
-    for body1, bodydict in body2body.items():
-        if body1 in eligible_bodies:
-            bodysave = -1
-            max_val = hard_lb
-            total_val = 0
-            for body2, val in bodydict.items():
-                total_val += val
-                if val > max_val:
-                    bodysave = body2
-                    max_val = val
-
-            if (int(body1), int(bodysave)) in retired_list:
-                # already in list
-                pass
-            elif bodysave == -1:
-                small_overlap_prune += 1
-            elif (mode == 1) and (max_val / float(total_val) < conservative_overlap):
-                conservative_prune += 1
-            elif (mode == 3) and (max_val / float(total_val) > conservative_overlap) and (max_val > liberal_lb):
-                merge_list.append([int(body1), int(bodysave)])
-                aggressive_add += 1
-            elif int(body1) in mutual_list:
-                partners = mutual_list[int(body1)]
-                if int(bodysave) in partners:
-                    merge_list.append([int(body1), int(bodysave)])
-                else:
-                    not_mutual += 1
-            else:
-                not_mutual += 1
-                    
-                    
-    # print stats
-    print "Small overlap prune: ", small_overlap_prune
-    print "Conservative (mode 1) overlap percentage prune: ", conservative_prune
-    print "Aggressive adding (mode 3) using overlap percentage for only one side: ", aggressive_add
-    print "No candidates merge found because not mutual: ", not_mutual
-    print "Num mergers: ", len(merge_list)
-
-    # output json
-    outjson = {}
-    outjson["id"] = json_data["id"]
-    outjson["merge_list"] = merge_list
-  
-    fout = open(json_data["output"], 'w')
-    jstr = json.dumps(outjson, indent=4)
-    fout.write(jstr)
-
+    eligible_bodies2 = set(numpy.unique(labels2[z1:z2, y1:y2, x1:x2]))
+    eligible_bodies1 = set(numpy.unique(labels1[z1:z2, y1:y2, x1:x2]))
+    eligible_bodies2.discard(0)
+    eligible_bodies1.discard(0)
+
+    mode, hard_lb, liberal_lb, conservative_overlap = stitch_policy(json_data)
+
+    table = None
+    if mode > 0 or "overlaps" in json_data:
+        # count all overlaps in one pass and read both directions from it
+        table = compute_overlap_table(labels1, labels2)
+    if "overlaps" in json_data:
+        # raw overlaps for deciding again with another policy (see redecide)
+        write_overlap_table(json_data["overlaps"], table, sorted(eligible_bodies1), sorted(eligible_bodies2))
+
+    write_merges(json_data, *decide_merges(table, eligible_bodies1, eligible_bodies2, mode, hard_lb, liberal_lb, conservative_overlap))
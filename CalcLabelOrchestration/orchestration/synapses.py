@@ -0,0 +1,112 @@
+import numpy
+
+"""
+Synapse annotations partitioned by substack.
+
+The annotation json is parsed once into columnar coordinate arrays (T-bar
+locations, and partner locations grouped by synapse) and the synapses are
+bucketed on a grid by T-bar location.  A substack only tests the synapses
+in the grid cells its (bordered) bounding box covers, so partitioning all
+substacks takes time linear in the number of synapses.
+"""
+
+class SynapseTable:
+    def __init__(self, data, cell_size):
+        self.data = data
+        synapses = data["data"]
+
+        self.tbars = numpy.array([synapse["T-bar"]["location"] for synapse in synapses], dtype=numpy.int64).reshape(-1, 3)
+        self.num_partners = numpy.array([len(synapse["partners"]) for synapse in synapses], dtype=numpy.int64)
+        self.partner_start = numpy.concatenate(([0], numpy.cumsum(self.num_partners)[:-1])).astype(numpy.int64)
+        self.partners = numpy.array([partner["location"] for synapse in synapses for partner in synapse["partners"]], dtype=numpy.int64).reshape(-1, 3)
+
+        # grid cell -> synapse indices
+        self.cell_size = max(int(cell_size), 1)
+        self.cells = {}
+        if len(self.tbars) > 0:
+            cells, inverse = unique_rows(self.tbars // self.cell_size)
+            order = numpy.argsort(inverse, kind="mergesort")
+            bounds = numpy.searchsorted(inverse[order], numpy.arange(len(cells) + 1))
+            for index, cell in enumerate(cells):
+                self.cells[tuple(cell)] = order[bounds[index]:bounds[index+1]]
+
+    # indices of synapses with a T-bar in the grid cells covering [lower, upper)
+    def candidates(self, lower, upper):
+        first = lower // self.cell_size
+        last = (upper - 1) // self.cell_size
+        found = []
+        for cx in range(first[0], last[0] + 1):
+            for cy in range(first[1], last[1] + 1):
+                for cz in range(first[2], last[2] + 1):
+                    if (cx, cy, cz) in self.cells:
+                        found.append(self.cells[(cx, cy, cz)])
+        if len(found) == 0:
+            return numpy.zeros(0, dtype=numpy.int64)
+        return numpy.sort(numpy.concatenate(found))
+
+    # indices (in file order) of synapses with at least one partner whose T-bar and partners are all in [lower, upper)
+    def find(self, lower, upper):
+        lower = numpy.asarray(lower, dtype=numpy.int64)
+        upper = numpy.asarray(upper, dtype=numpy.int64)
+        if numpy.any(upper <= lower):
+            return numpy.zeros(0, dtype=numpy.int64)
+
+        indices = self.candidates(lower, upper)
+        keep = inside(self.tbars[indices], lower, upper) & (self.num_partners[indices] > 0)
+        indices = indices[keep]
+
+        # gather partner rows of the remaining synapses
+        counts = self.num_partners[indices]
+        offsets = numpy.repeat(self.partner_start[indices] - numpy.concatenate(([0], numpy.cumsum(counts)[:-1])), counts)
+        partner_rows = offsets + numpy.arange(counts.sum())
+
+        outside = ~inside(self.partners[partner_rows], lower, upper)
+        owners = numpy.repeat(numpy.arange(len(indices)), counts)
+        keep = numpy.ones(len(indices), dtype=bool)
+        keep[owners[outside]] = False
+        return indices[keep]
+
+    # synapse json with locations relative to lower and y flipped (raveler y format)
+    def local_data(self, indices, lower, upper):
+        lower = numpy.asarray(lower, dtype=numpy.int64)
+        dims = numpy.asarray(upper, dtype=numpy.int64) - lower
+
+        synapse_list = []
+        for index in indices.tolist():
+            synapse = self.data["data"][index]
+            tbar = dict(synapse["T-bar"])
+            tbar["location"] = local_location(self.tbars[index], lower, dims)
+
+            start = self.partner_start[index]
+            partners = []
+            for offset, partner in enumerate(synapse["partners"]):
+                partner = dict(partner)
+                partner["location"] = local_location(self.partners[start + offset], lower, dims)
+                partners.append(partner)
+
+            new_synapse = dict(synapse)
+            new_synapse["T-bar"] = tbar
+            new_synapse["partners"] = partners
+            synapse_list.append(new_synapse)
+
+        new_data = {}
+        new_data["data"] = synapse_list
+        new_data["metadata"] = self.data["metadata"]
+        return new_data
+
+# true for every point (row) in [lower, upper)
+def inside(points, lower, upper):
+    return numpy.all((points >= lower) & (points < upper), axis=1)
+
+# location relative to lower with y flipped
+def local_location(location, lower, dims):
+    location = location - lower
+    location[1] = dims[1] - location[1] - 1
+    return [int(val) for val in location]
+
+# distinct rows of a 2D integer array and the row index of each input row
+def unique_rows(rows):
+    rows = numpy.ascontiguousarray(rows)
+    packed = rows.view(numpy.dtype((numpy.void, rows.dtype.itemsize * rows.shape[1])))
+    unique, first, inverse = numpy.unique(packed, return_index=True, return_inverse=True)
+    return rows[first], inverse
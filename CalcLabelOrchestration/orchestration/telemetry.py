@@ -0,0 +1,136 @@
+import json
+import os
+import time
+import numpy
+
+"""
+Per-job metrics for a session.
+
+For every job the submit time, start and end time (from the executor's
+resource usage, e.g. DRMAA JobInfo.resourceUsage) and resource usage are
+written as one json line to job_metrics.jsonl in the session directory.
+The end-of-run summary (job_summary.json) has queue wait and runtime
+percentiles for each stage.
+"""
+
+metricsName = "job_metrics.jsonl"
+summaryName = "job_summary.json"
+
+# resource usage values that are numbers (DRMAA reports strings)
+def usage_value(resource_usage, key):
+    try:
+        return float(resource_usage[key])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+# epoch seconds (some DRMAA implementations report milliseconds)
+def usage_time(resource_usage, key):
+    value = usage_value(resource_usage, key)
+    if value is not None and value > 1e11:
+        value /= 1000.0
+    if value is not None and value <= 0:
+        value = None
+    return value
+
+class JobMetrics:
+    def __init__(self, session_location):
+        self.filename = session_location + "/" + metricsName
+        self.summaryname = session_location + "/" + summaryName
+        self.submitted = {}
+        self.records = []
+
+    # forget metrics of previous runs (fresh run)
+    def clear(self):
+        self.records = []
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def submit(self, job_id, stage, name):
+        self.submitted[job_id] = (stage, name, time.time())
+
+    # record finished job (executor JobResult)
+    def finish(self, result):
+        stage, name, submit_time = self.submitted.pop(result.job_id)
+        finish_time = time.time()
+        usage = result.resource_usage
+
+        record = {}
+        record["job_id"] = str(result.job_id)
+        record["stage"] = stage
+        record["name"] = name
+        record["success"] = result.success
+        record["exit_status"] = result.exit_status
+        record["submit_time"] = submit_time
+        record["finish_time"] = finish_time
+        record["start_time"] = usage_time(usage, "start_time")
+        record["end_time"] = usage_time(usage, "end_time")
+
+        # times are only known at job granularity if the executor does not report them
+        end_time = record["end_time"]
+        if end_time is None:
+            end_time = finish_time
+        record["queue_wait"] = None
+        record["runtime"] = None
+        if record["start_time"] is not None:
+            record["queue_wait"] = max(record["start_time"] - submit_time, 0)
+            record["runtime"] = max(end_time - record["start_time"], 0)
+
+        record["cpu"] = usage_value(usage, "cpu")
+        record["maxvmem"] = usage_value(usage, "maxvmem")
+        record["resource_usage"] = dict(usage)
+        self.records.append(record)
+
+        fout = open(self.filename, 'a')
+        fout.write(json.dumps(record) + "\n")
+        fout.close()
+
+    # percentiles of queue wait and runtime for each stage, written to the summary file
+    def summary(self):
+        stages = []
+        by_stage = {}
+        for record in self.records:
+            if record["stage"] not in by_stage:
+                stages.append(record["stage"])
+                by_stage[record["stage"]] = []
+            by_stage[record["stage"]].append(record)
+
+        summary = []
+        for stage in stages:
+            records = by_stage[stage]
+            stage_summary = {}
+            stage_summary["stage"] = stage
+            stage_summary["num_jobs"] = len(records)
+            stage_summary["num_failed"] = len([record for record in records if not record["success"]])
+            for key in ("queue_wait", "runtime", "cpu", "maxvmem"):
+                stage_summary[key] = percentiles([record[key] for record in records])
+            summary.append(stage_summary)
+
+        fout = open(self.summaryname, 'w')
+        fout.write(json.dumps(summary, indent=4))
+        fout.close()
+        return summary
+
+    # html summary for status messages
+    def summary_html(self):
+        message = ""
+        for stage_summary in self.summary():
+            message += "<b>Job description: " + stage_summary["stage"] + "</b><br>"
+            message += "Num completed jobs: " + str(stage_summary["num_jobs"]) + " (" + str(stage_summary["num_failed"]) + " failed)<br>"
+            for key, desc in (("runtime", "Runtime"), ("queue_wait", "Queue wait")):
+                values = stage_summary[key]
+                if values is not None:
+                    message += desc + " p50/p90/max: %.1f/%.1f/%.1f seconds<br>" % (values["p50"], values["p90"], values["max"])
+        return message
+
+# p50, p90, p99 and max of values that are known
+def percentiles(values):
+    values = [value for value in values if value is not None]
+    if len(values) == 0:
+        return None
+    values = numpy.array(values, dtype=numpy.float64)
+    result = {}
+    for percent in (50, 90, 99):
+        result["p" + str(percent)] = float(numpy.percentile(values, percent))
+    result["max"] = float(values.max())
+    result["mean"] = float(values.mean())
+    return result
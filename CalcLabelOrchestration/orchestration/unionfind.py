@@ -0,0 +1,90 @@
+import numpy
+
+"""
+Array-backed union-find over a dense body id space.
+
+Parents are stored in a NumPy array indexed by body id (ids 0 to size-1).
+Whole merge lists are joined in rounds of vectorized min-label hooking
+(every root is linked to the smallest root it is paired with) followed by
+pointer jumping, which fully compresses the path of every touched body.
+"""
+
+class UnionFind:
+    def __init__(self, size):
+        self.dtype = numpy.uint32
+        if size > numpy.iinfo(numpy.uint32).max:
+            self.dtype = numpy.uint64
+        self.parent = numpy.arange(size, dtype=self.dtype)
+
+    # fully compress the paths of the given bodies, returns their roots
+    def _compress(self, bodies):
+        parent = self.parent
+        while True:
+            curr = parent[bodies]
+            grand = parent[curr]
+            if (curr == grand).all():
+                return curr
+            parent[bodies] = grand
+
+    # join the sets of every (bodies1[i], bodies2[i]) pair
+    def union_pairs(self, bodies1, bodies2):
+        bodies1 = numpy.asarray(bodies1, dtype=self.dtype)
+        bodies2 = numpy.asarray(bodies2, dtype=self.dtype)
+        if len(bodies1) == 0:
+            return
+
+        # every body whose parent can change (or that is a parent) is in this set
+        touched = numpy.zeros(len(self.parent), dtype=bool)
+        touched[bodies1] = True
+        touched[bodies2] = True
+        touched[self._compress(bodies1)] = True
+        touched[self._compress(bodies2)] = True
+        touched = numpy.nonzero(touched)[0].astype(self.dtype)
+
+        while len(bodies1) > 0:
+            self._compress(touched)
+            roots1 = self.parent[bodies1]
+            roots2 = self.parent[bodies2]
+
+            # drop pairs that are already joined
+            differ = roots1 != roots2
+            bodies1 = bodies1[differ]
+            bodies2 = bodies2[differ]
+            roots1 = roots1[differ]
+            roots2 = roots2[differ]
+
+            # hook every larger root onto its smallest partner root (parents
+            # only decrease, so no cycles are possible); a plain fancy
+            # assignment would keep just one partner per root per round
+            low = numpy.minimum(roots1, roots2)
+            high = numpy.maximum(roots1, roots2)
+            numpy.minimum.at(self.parent, high, low)
+
+        # leave the trees flat
+        self._compress(touched)
+
+    # return (bodies, targets) mapping every merged body to the smallest id in its set
+    def mappings(self):
+        merged = numpy.nonzero(self.parent != numpy.arange(len(self.parent), dtype=self.dtype))[0]
+        merged = merged.astype(self.dtype)
+        if len(merged) == 0:
+            empty = numpy.zeros(0, dtype=numpy.uint64)
+            return empty, empty
+
+        # merged bodies and their roots, in increasing order
+        bodies = numpy.zeros(len(self.parent), dtype=bool)
+        bodies[merged] = True
+        bodies[self._compress(merged)] = True
+        bodies = numpy.nonzero(bodies)[0].astype(self.dtype)
+        roots = self.parent[bodies]
+
+        # smallest body for each root (stable sort keeps bodies increasing)
+        order = numpy.argsort(roots, kind="mergesort")
+        bodies = bodies[order]
+        roots = roots[order]
+        first = numpy.concatenate(([True], roots[1:] != roots[:-1]))
+        smallest = bodies[first]
+        targets = smallest[numpy.cumsum(first) - 1]
+
+        keep = bodies != targets
+        return bodies[keep].astype(numpy.uint64), targets[keep].astype(numpy.uint64)
@@ -0,0 +1,50 @@
+import argparse
+import json
+from orchestration.remap_labels import SlabRemapper
+from orchestration.label_io import create_labels
+from orchestration.dvid_writer import LabelWriter, BLOCK_SIZE, print_peak_memory
+
+"""
+Fused remap and commit of a substack.
+
+The substack core is read from segmentation.h5 one z slab at a time, offset
+and remapped with the consolidated mappings and posted to DVID straight away,
+so the remapped volume never goes through disk.  Slabs start at DVID block
+boundaries so every block is posted whole by one slab.  The body sizes used
+for body assignment are written as by remap_labels; the remapped volume
+(segmentation2.h5) is only written when "write-remapped" is set (debugging).
+"""
+
+def execute(argv):
+    parser = argparse.ArgumentParser(description="Remaps h5 and writes it to DVID")
+    parser.add_argument('config_file', type=str, help="Location of configuration json")
+    args = parser.parse_args()
+
+    json_data = json.load(open(args.config_file))
+    bbox1 = json_data["bbox1"]
+    remapper = SlabRemapper(json_data, bbox1[2], BLOCK_SIZE)
+
+    fout = dset = None
+    if json_data.get("write-remapped", False):
+        fout, dset = create_labels(json_data["labelsout"], remapper.shape, remapper.max_label, remapper.label_format)
+
+    writer = LabelWriter(json_data["server"], json_data["uuid"], json_data["labelname"], json_data["roi"],
+            compression=json_data.get("dvid-compression", "gzip"))
+    num_written = num_skipped = 0
+    for start, end, labels in remapper.remapped_slabs():
+        written, skipped = writer.write(labels, (bbox1[0], bbox1[1], bbox1[2] + start), json_data.get("skip-empty-blocks", False))
+        num_written += written
+        num_skipped += skipped
+        if dset is not None:
+            dset[start:end] = labels
+    if fout is not None:
+        fout.close()
+
+    remapper.write_body_sizes(json_data["bodiesout"])
+
+    print "Slabs: ", len(remapper.slabs)
+    print "Blocks written: ", num_written
+    print "Empty blocks skipped: ", num_skipped
+    print "Posts: ", writer.num_posts, " (" + str(writer.num_tries) + " tries)"
+    print "Bytes sent: ", writer.bytes_sent
+    print_peak_memory()
@@ -0,0 +1,80 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from orchestration.incremental import Reconciliation
+from orchestration.relabel import write_mapping_shard, mapping_arrays, remapShardName
+
+# the parts of calclabels_cluster.Substack that Reconciliation uses
+class FakeSubstack:
+    def __init__(self, session_location, id_offset, max_id):
+        self.session_location = session_location
+        self.id_offset = id_offset
+        self.max_id = max_id
+
+class ReconciliationTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    # substacks with the given (offset, max id) and previous remap shards ([old, new] lists)
+    def make_substacks(self, ranges, shards):
+        substacks = []
+        for index, (id_offset, max_id) in enumerate(ranges):
+            location = os.path.join(self.tmpdir, str(index))
+            os.mkdir(location)
+            keys, values = mapping_arrays(shards.get(index, []))
+            write_mapping_shard(location + "/" + remapShardName, keys, values)
+            substacks.append(FakeSubstack(location, id_offset, max_id))
+        return substacks
+
+    def reconcile(self, substacks, changed, merges):
+        merges = numpy.array(merges, dtype=numpy.uint64).reshape(-1, 2)
+        order = numpy.argsort(merges[:, 0], kind="mergesort")
+        return Reconciliation(substacks, changed, merges[order, 0], merges[order, 1])
+
+    def mapping(self, reconciliation, index):
+        keys, values = reconciliation.mapping(index)
+        return dict(zip(keys.tolist(), values.tolist()))
+
+    # the body that labels an old set moves with the set to a smaller label
+    def test_label_body_follows_its_set(self):
+        # old set {3, 11, 25} had label 3; substack 2 is segmented again from offset 30
+        substacks = self.make_substacks([(0, 10), (10, 10), (30, 10)], {1: [[11, 3]]})
+        reconciliation = self.reconcile(substacks, [2], [[11, 2], [31, 2]])
+
+        self.assertEqual(self.mapping(reconciliation, 0), {3: 2})
+        self.assertEqual(self.mapping(reconciliation, 1), {11: 2})
+        self.assertEqual(self.mapping(reconciliation, 2), {31: 2})
+        self.assertEqual(reconciliation.rewrite, [0, 1, 2])
+
+    # unchanged bodies joined only through a body of a changed substack stay joined
+    def test_bridge_merge_is_kept(self):
+        # old set {2, 15, 24, 26} had label 15 (15 was in substack 1, segmented again from
+        # offset 30), and 5 had label 3
+        substacks = self.make_substacks([(0, 10), (30, 10), (20, 10)],
+                {0: [[2, 15], [5, 3]], 2: [[24, 15], [26, 15]]})
+        reconciliation = self.reconcile(substacks, [1], [[3, 2], [33, 2]])
+
+        self.assertEqual(self.mapping(reconciliation, 0), {2: 3, 5: 3})
+        self.assertEqual(self.mapping(reconciliation, 1), {33: 3})
+        self.assertEqual(self.mapping(reconciliation, 2), {24: 3, 26: 3})
+        self.assertEqual(reconciliation.rewrite, [0, 1, 2])
+
+    # substacks whose labels do not change are not written again
+    def test_untouched_substack_is_not_rewritten(self):
+        substacks = self.make_substacks([(0, 10), (30, 10), (20, 10)], {2: [[24, 21]]})
+        reconciliation = self.reconcile(substacks, [1], [[33, 31]])
+
+        self.assertEqual(self.mapping(reconciliation, 1), {33: 31})
+        self.assertEqual(self.mapping(reconciliation, 2), {24: 21})
+        self.assertEqual(reconciliation.rewrite, [1])
+
+if __name__ == "__main__":
+    unittest.main()